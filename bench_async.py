@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark du client asynchrone (AsyncBeta) contre Beta.
+
+Fait les mêmes file_subtitles sur la fausse api de bench_pool.py: une
+par une avec Beta, toutes ensemble avec AsyncBeta (au plus limit requêtes
+en cours).  Vérifie que les deux clients retournent les mêmes sous-titres.
+Demande trollius.
+
+    python bench_async.py
+        5 séries x 8 épisodes, 20 ms de latence par réponse
+
+    python bench_async.py 20 0.05 10
+        20 épisodes par série, 50 ms de latence, limit=10
+
+"""
+import sys
+import time
+import logging
+
+import betasub
+from bench_pool import start_stub, video_names
+
+
+
+def sync_lookups(server, names):
+    """file_subtitles avec Beta, une vidéo après l'autre.
+
+    """
+    beta = betasub.Beta()
+    beta.api_url = server.url()
+    try:
+        return [beta.file_subtitles(name) for name in names]
+    finally:
+        beta.pool.close()
+
+
+
+def async_lookups(server, names, limit=20):
+    """file_subtitles avec AsyncBeta, toutes les vidéos en même temps.
+
+    """
+    beta = betasub.AsyncBeta(limit=limit)
+    beta.api_url = server.url()
+    loop = betasub.asyncio.get_event_loop()
+    return loop.run_until_complete(betasub.asyncio.gather(
+                *[beta.file_subtitles(name) for name in names]))
+
+
+
+def run(names, delay=0.02, limit=20):
+    """Chronomètre les deux clients et compare leurs résultats.
+
+    """
+    print "%s videos, %s ms per response, limit %s" % (len(names), delay * 1000, limit)
+    results = {}
+    #un seul serveur: les urls des sous-titres (port compris) sont comparées
+    server = start_stub(delay)
+    try:
+        for label, lookups in [('Beta', sync_lookups),
+                               ('AsyncBeta', lambda server, names: async_lookups(server, names, limit))]:
+            server.requests = 0
+            start = time.time()
+            results[label] = lookups(server, names)
+            elapsed = time.time() - start
+            found = sum(1 for subtitles in results[label] if subtitles)
+            print "%-10s %.3fs  requests: %s  found: %s" % (label, elapsed,
+                                                           server.requests, found)
+    finally:
+        server.shutdown()
+        server.server_close()
+    same = [sorted(subtitles) for subtitles in results['Beta']] == \
+           [sorted(subtitles) for subtitles in results['AsyncBeta']]
+    print "identical results: %s" % same
+
+
+
+if __name__ == '__main__':
+    if betasub.asyncio is None:
+        sys.exit("bench_async.py needs trollius (pip install trollius)")
+    logging.disable(logging.INFO)
+    episodes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+    limit = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    run(video_names(episodes), delay, limit)
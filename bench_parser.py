@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark de l'analyse des noms de fichiers (FilenameParser).
+
+Compare FilenameParser à l'ancien Beta.extract_data (regex compilées à
+chaque appel, 20 str.replace pour les dates) sur un corpus de noms:
+mêmes résultats, et temps à froid (cache vide), à chaud et par
+parse_many.
+
+    python bench_parser.py
+        corpus généré: ~4500 noms (SxxExx, NxNN, 3 et 4 chiffres, dates,
+        langues, V (2009), noms sans épisode)
+
+    python bench_parser.py noms.txt
+        liste réelle: un nom de fichier par ligne
+
+"""
+import re
+import sys
+import time
+import random
+
+import betasub
+
+SHOWS = ['Chuck', 'Lost', 'The Office', 'Doctor Who 2005', 'V', 'Fringe',
+         'Grey\'s Anatomy', 'Law and Order SVU', 'House M.D.', '24']
+LANGUAGES = ['', 'fr', 'en', 'VF', 'VO', 'vovf', 'FREN', 'enfr', 'vfvo']
+TAGS = ['HDTV.XviD-LOL', '720p.HDTV.x264-IMMERSE', 'WEB-DL.DD5.1.H264',
+        '[eztv]', '(2010)', 'PROPER_REPACK', 'french', '']
+
+
+
+def old_extract_data(value):
+    """Ancien Beta.extract_data, recopié tel quel.
+
+    """
+    #regex pour la recherche
+    pattern1 = re.compile(r"""
+          ^(?P<show>.*?)\s*                     #show
+          (                                     #season,episode
+          season?|saison?|[s .n]?(?P<season>\d+)#season
+          [e .x]?(?P<episode>\d+)?              #episode
+          )+
+          .*                                    #any before language
+          [ .]+(?P<language>fren|enfr|vovf|vfvo|fr|en|vo|vf)+? #language
+          .*?$ #end
+          """,re.IGNORECASE|re.VERBOSE)
+
+    #deuxième regex pour ceux sans langue:
+    pattern2 = re.compile(r"""
+          ^(?P<show>.*?)\s*                     #show
+          (                                     #season,episode
+          season?|saison?|[s .n]?(?P<season>\d+)#season
+          [e .x]?(?P<episode>\d+)?              #episode
+          )+
+          (?P<language>)?                       #MODIF.
+          """,re.IGNORECASE|re.VERBOSE)
+    #remplace les caract. inutiles
+    value = re.sub('[\.\-\_\,\:\;\[\]\(\)]',' ',value)
+    #remplace les dates
+    for date in range(2000, 2020):
+      value = value.replace(str(date), '')
+    #solution pour premier regex
+    pattern1 = re.match(pattern1,value)
+    #autre possibilité pour regex 2
+    pattern2 = re.match(pattern2,value)
+    #si correspondant à regex 1:
+    if pattern1:
+        result = pattern1.groupdict('')#''=defaut instead None
+    #si correspondant à regex 2:
+    elif pattern2:
+        result = pattern2.groupdict('')
+    else:
+        return False
+    #accepting there is no season with 3 digits
+    season = result['season']
+    if len(season) == 3:
+        result["season"] = season[0]
+        result["episode"] = season[1:]
+    #accepting there is no season with 4 digits
+    season = result['season']
+    if len(season) >= 4:
+        result["season"] = season[0:2]
+        result["episode"] = season[2:]
+
+    show = result['show'].strip()
+    season = result['season']
+    episode = result['episode']
+    #normalisation langue
+    language = result['language'].lower()
+    language = re.sub('fren|enfr|vfvo','vovf',language)
+    language = re.sub('en','vo',language)
+    language = re.sub('fr','vf',language)
+
+    #exceptions pour certaines séries ex: V(2009).
+    if show.lower() == 'v':
+        return  ['V (2009)', season, episode, language]
+    else:
+        return  [show, season, episode, language]
+
+
+
+def corpus(size=4500):
+    """Noms de fichiers variés, avec des doublons comme dans une vraie liste.
+
+    """
+    episode_formats = ['S%02dE%02d', 's%de%02d', '%dx%02d', '%d%02d', '%02d%02d',
+                       'Season %d Episode %02d', 'Saison %d %02d']
+    names = []
+    while len(names) < size:
+        show = random.choice(SHOWS)
+        season = random.randint(1, 12)
+        episode = random.randint(1, 24)
+        number = random.choice(episode_formats) % (season, episode)
+        separator = random.choice(['.', ' ', ' - ', '_'])
+        parts = [show.replace(' ', separator.strip() or ' '), number,
+                 random.choice(TAGS), random.choice(LANGUAGES)]
+        name = separator.join(part for part in parts if part)
+        names.append(name + random.choice(['.avi', '.mkv', '.srt', '.mp4']))
+        #noms sans saison ni épisode, et doublons
+        if random.random() < 0.05:
+            names.append(random.choice(['readme.txt', 'sample.avi', 'Thumbs.db',
+                                        '%s.avi' % show]))
+        if random.random() < 0.1:
+            names.append(random.choice(names))
+    return names
+
+
+
+def run(names):
+    """Vérifie que les résultats sont identiques, puis chronomètre.
+
+    """
+    print "%s names (%s distinct)" % (len(names), len(set(names)))
+    start = time.time()
+    expected = [old_extract_data(name) for name in names]
+    print "%-14s %.4fs" % ('old', time.time() - start)
+
+    parser = betasub.FilenameParser()
+    start = time.time()
+    results = [parser.parse(name) for name in names]
+    print "%-14s %.4fs" % ('parser (cold)', time.time() - start)
+    start = time.time()
+    [parser.parse(name) for name in names]
+    print "%-14s %.4fs" % ('parser (warm)', time.time() - start)
+    start = time.time()
+    columns = betasub.FilenameParser().parse_many(names)
+    print "%-14s %.4fs" % ('parse_many', time.time() - start)
+
+    different = [(name, old, new) for name, old, new in zip(names, expected, results)
+                 if old != new]
+    many = [False] * len(names)
+    for num, index in enumerate(columns['index']):
+        many[index] = [columns['shows'][num], columns['seasons'][num],
+                       columns['episodes'][num], columns['languages'][num]]
+    different += [(name, old, new) for name, old, new in zip(names, expected, many)
+                  if old != new]
+    print "different results: %s" % len(different)
+    for name, old, new in different[:10]:
+        print "  %r: %r != %r" % (name, old, new)
+
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    if len(sys.argv) == 2:
+        names = [line.strip() for line in open(sys.argv[1]) if line.strip()]
+    else:
+        names = corpus()
+    run(names)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark des connexions HTTP persistantes (HTTPPool).
+
+Lance une fausse api Betaseries en local, puis fait la même série de
+file_subtitles et de téléchargements avec un pool qui garde ses
+connexions (keep-alive) et avec un pool qui n'en garde aucune (une
+connexion par requête, comme urllib2 avant HTTPPool).  Le serveur compte
+les connexions TCP qu'il accepte.
+
+    python bench_pool.py
+        5 séries x 8 épisodes, réponses immédiates
+
+    python bench_pool.py 20 0.01
+        20 épisodes par série, 10 ms de latence par réponse
+
+"""
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import logging
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+import betasub
+
+SHOWS = ['Chuck', 'Lost', 'Dexter', 'The Office', 'Fringe']
+
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Fausse api: recherche de série, sous-titres d'un épisode, fichiers.
+
+    """
+    protocol_version = 'HTTP/1.1'
+    #réponse envoyée d'un bloc: sinon Nagle + ACK retardé ajoutent 40 ms
+    #par réponse sur une connexion gardée
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, content_type='application/json'):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        parts = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(parts.query))
+        if parts.path == '/shows/search.json':
+            title = query.get('title', '')
+            shows = {'0': {'url': title.replace(' ', ''), 'title': title.title()}}
+            return self.send(json.dumps({'root': {'shows': shows}}))
+        if parts.path.startswith('/subtitles/show/'):
+            show = parts.path.split('/')[-1][:-5]
+            subtitles = {}
+            for num, language in enumerate(['VF', 'VO']):
+                name = '%s.S%sE%s.%s' % (show, query.get('season'),
+                                         query.get('episode'), language)
+                subtitles[str(num)] = {
+                    'title': show, 'season': query.get('season'),
+                    'episode': query.get('episode'), 'language': language,
+                    'source': 'addic7ed', 'quality': 3, 'file': name + '.srt',
+                    'url': 'http://%s/files/%s.srt' % (self.headers['host'], name)}
+            return self.send(json.dumps({'root': {'subtitles': subtitles}}))
+        if parts.path.startswith('/files/'):
+            return self.send('1\n00:00:01,000 --> 00:00:02,000\nsub\n' * 200,
+                             'application/octet-stream')
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serveur de la fausse api, un thread par connexion.
+
+    """
+    daemon_threads = True
+    #file d'attente de listen: 5 par défaut, trop peu pour AsyncBeta
+    request_queue_size = 128
+
+    def __init__(self, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+
+
+def start_stub(delay=0):
+    """Démarre la fausse api dans un thread, retourne le serveur.
+
+    """
+    server = StubServer(delay)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+
+def video_names(episodes=8):
+    """Noms de vidéos pour toutes les séries de SHOWS.
+
+    """
+    return ['%s.S01E%02d.HDTV.XviD-LOL.avi' % (show.replace(' ', '.'), episode)
+            for show in SHOWS for episode in range(1, episodes + 1)]
+
+
+
+def lookup_all(server, pool, names, directory):
+    """file_subtitles pour chaque nom, puis téléchargement du premier résultat.
+
+    """
+    beta = betasub.Beta(pool=pool)
+    beta.api_url = server.url()
+    sub = betasub.Sub(pool=pool)
+    found = 0
+    for name in names:
+        subtitles = beta.file_subtitles(name)
+        if subtitles:
+            found += 1
+            sub.download_file(subtitles[0]['file'], subtitles[0]['url'], directory)
+    return found
+
+
+
+def run(names, delay=0):
+    """Compare un pool keep-alive à un pool sans connexions gardées.
+
+    """
+    print "%s videos, %s ms per response" % (len(names), delay * 1000)
+    for label, pool_size in [('no reuse', 0), ('keep-alive', 4)]:
+        server = start_stub(delay)
+        directory = tempfile.mkdtemp()
+        pool = betasub.HTTPPool(pool_size)
+        try:
+            start = time.time()
+            found = lookup_all(server, pool, names, directory)
+            elapsed = time.time() - start
+        finally:
+            pool.close()
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(directory)
+        print "%-10s %.3fs  requests: %s  connections: %s  (pool.opened %s)  found: %s" % (
+                label, elapsed, server.requests, server.connections, pool.opened, found)
+
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    episodes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    run(video_names(episodes), delay)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmark du choix du sous-titre (SubtitleRanker).
+
+Compare SubtitleRanker.best à l'ancienne règle de best_subtitle
+(difflib.SequenceMatcher sur chaque fichier) sur des packs de saison.
+
+    python bench_ranker.py
+        packs générés: 22 épisodes, 4 sources, 3 releases x 4 langues
+
+    python bench_ranker.py "The.Office.S03E05.HDTV.XviD-LOL.avi" liste.txt
+        liste réelle: un nom de fichier par ligne (unzip -l d'un pack...)
+
+"""
+import os
+import sys
+import time
+import random
+import difflib
+
+import betasub
+
+RELEASES = ['HDTV.XviD-LOL', '720p.HDTV.x264-IMMERSE', 'HDTV.x264-2HD',
+            'WEB-DL.720p.DD5.1.H264-BS', '1080p.WEB-DL.DD5.1.H.264-ECI',
+            'HDTV.x264-ASAP', 'PROPER.HDTV.x264-KILLERS']
+
+
+
+def season_pack(show, season, episodes=22):
+    """Noms de fichiers d'un pack de saison, façon addic7ed/tvsubtitles.
+
+    """
+    names = []
+    for episode in range(1, episodes + 1):
+        for release in random.sample(RELEASES, 3):
+            for language in ['FR', 'EN', 'VF', 'VO']:
+                names.append('%s.S%02dE%02d.%s.%s.srt' % (show, season, episode,
+                                                          release, language))
+        names.append('%s - %dx%02d.%s.txt' % (show.replace('.', ' '), season,
+                                             episode, random.choice(RELEASES)))
+    return names
+
+
+
+def difflib_best(movie_name, candidates):
+    """Ancienne règle: difflib sur chaque fichier, qualité puis ressemblance.
+
+    """
+    score = 0
+    quality = 0
+    winner = None
+    for path, name, sub_quality in candidates:
+        ratio = difflib.SequenceMatcher(None, movie_name, name).ratio()
+        if ratio >= score and sub_quality >= quality:
+            score = ratio
+            quality = sub_quality
+            winner = path
+    return winner
+
+
+
+def ranker_best(movie_name, candidates):
+    """Nouvelle règle: SubtitleRanker, fichiers de sous-titres seulement.
+
+    """
+    ranker = betasub.SubtitleRanker(movie_name)
+    return ranker.best((path, name, quality) for path, name, quality in candidates
+                       if os.path.splitext(path)[1][1:].lower() in ranker.extensions)
+
+
+
+def same_episode(movie_name, path):
+    """True si le fichier gagnant est bien celui de l'épisode de la vidéo.
+
+    """
+    ranker = betasub.SubtitleRanker(movie_name)
+    return (ranker.number is not None and
+            ranker.number == ranker.episode_number(os.path.basename(path).lower()))
+
+
+
+def run(cases, repeat=3):
+    """Chronomètre les deux règles sur cases = [(movie_name, candidates), ...].
+
+    """
+    files = sum(len(candidates) for movie_name, candidates in cases)
+    print "%s videos, %s candidate files" % (len(cases), files)
+    for label, best in [('difflib', difflib_best), ('ranker', ranker_best)]:
+        start = time.time()
+        for i in range(repeat):
+            winners = [best(movie_name, candidates) for movie_name, candidates in cases]
+        elapsed = (time.time() - start) / repeat
+        right = sum(1 for (movie_name, candidates), winner in zip(cases, winners)
+                    if winner and same_episode(movie_name, winner))
+        print "%-8s %.4fs  (%.1f us/file)  right episode: %s/%s" % (
+                label, elapsed, elapsed * 1e6 / max(files, 1), right, len(cases))
+
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    if len(sys.argv) == 3:
+        movie_name = os.path.splitext(os.path.basename(sys.argv[1]))[0]
+        names = [line.strip() for line in open(sys.argv[2]) if line.strip()]
+        cases = [(movie_name, [(name, os.path.splitext(os.path.basename(name))[0], 3)
+                               for name in names])]
+    else:
+        cases = []
+        for episode in range(1, 23):
+            movie_name = 'The.Office.S03E%02d.%s' % (episode, random.choice(RELEASES))
+            candidates = []
+            for source in range(4):
+                quality = random.choice([1, 2, 3, 4, 5])
+                candidates.extend((name, os.path.splitext(name)[0], quality)
+                                  for name in season_pack('The.Office', 3))
+            cases.append((movie_name, candidates))
+    run(cases)
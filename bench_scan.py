@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark du parcours des dossiers de vidéos (Sub.scan).
+
+Compare Sub.files_list (un seul listing par dossier), avec scandir s'il
+est présent et avec os.listdir, à l'ancien files_list (os.walk puis un
+glob par extension) sur une arborescence.  L'ancien ne trouve pas les extensions en majuscules
+(.AVI, .Mkv...), d'où des totaux différents.
+
+    python bench_scan.py
+        arborescence générée dans un dossier temporaire:
+        100000 fichiers dans 200 dossiers, effacée à la fin
+
+    python bench_scan.py 20000 50
+        20000 fichiers dans 50 dossiers
+
+    python bench_scan.py d:\\series
+        dossier existant, parcouru sans rien modifier
+
+"""
+import os
+import sys
+import glob
+import time
+import random
+import shutil
+import logging
+import tempfile
+
+import betasub
+
+EXTENSIONS = ['avi', 'mkv', 'mp4']
+#extensions des fichiers générés: vidéos (casses variées) et le reste
+NAMES = ['avi', 'mkv', 'mp4', 'AVI', 'Mkv', 'MP4', 'srt', 'nfo', 'txt', 'jpg', 'zip']
+
+
+
+def old_files_list(directory, extensions=EXTENSIONS, subfolders=False):
+    """Ancien Sub.files_list, recopié tel quel.
+
+    """
+    all_files = []
+    #si on veut les sous-dossiers
+    if subfolders == True:
+        for root, dirs, names in os.walk(directory):
+            subdir = os.path.join(root,"")
+            for ext in extensions:
+                for files in glob.glob(subdir+'*.%s' % ext):
+                    all_files.append(files)
+    else:
+        for ext in extensions:
+            for files in glob.glob(directory+'*.%s' % ext):
+                all_files.append(files)
+    return all_files
+
+
+
+def make_tree(directory, files=100000, folders=200):
+    """Crée files fichiers vides répartis dans folders dossiers (sur 2 niveaux).
+
+    """
+    paths = []
+    for num in range(folders):
+        if num % 10 and paths:
+            #un dossier sur dix à la racine, les autres dedans
+            path = os.path.join(random.choice(paths[::10]), 'Season %d' % num)
+        else:
+            path = os.path.join(directory, 'Show %d' % num)
+        os.makedirs(path)
+        paths.append(path)
+    for num in range(files):
+        name = 'Show.S01E%03d.%s' % (num, random.choice(NAMES))
+        #quelques fichiers cachés, ignorés par les deux versions
+        if num % 50 == 0:
+            name = '.' + name
+        open(os.path.join(random.choice(paths), name), 'w').close()
+
+
+
+def run(directory, repeat=3):
+    """Chronomètre les versions sur directory (sous-dossiers compris), le
+    meilleur de repeat passages.
+
+    """
+    directory = os.path.join(directory, '')
+    sub = betasub.Sub()
+    versions = [('old', old_files_list, betasub.scandir)]
+    if betasub.scandir is not None:
+        versions.append(('scan (scandir)', sub.files_list, betasub.scandir))
+    #sans scandir (python 2 sans le module scandir): os.listdir + os.stat
+    versions.append(('scan (listdir)', sub.files_list, None))
+    default = betasub.scandir
+    try:
+        for label, files_list, scandir in versions:
+            betasub.scandir = scandir
+            best = None
+            for i in range(repeat):
+                start = time.time()
+                found = files_list(directory, EXTENSIONS, True)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            print "%-15s %.3fs  %s files" % (label, best, len(found))
+    finally:
+        betasub.scandir = default
+
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    random.seed(1)
+    if len(sys.argv) == 2:
+        run(sys.argv[1])
+    else:
+        files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+        folders = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        directory = tempfile.mkdtemp()
+        try:
+            make_tree(directory, files, folders)
+            print "%s files in %s folders" % (files, folders)
+            run(directory)
+        finally:
+            shutil.rmtree(directory)
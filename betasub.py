@@ -16,503 +16,2358 @@ __version__ = '0.6'
 
 import os
 import sys
+import errno
 import urllib
 import urllib2
+import urlparse
+import httplib
+import socket
 import hashlib
+import email.utils
+import zlib
 import json
 import time
 import re
-import glob,zipfile
+import zipfile
+import collections
+import itertools
 import sqlite3
-import difflib
 import shutil
+import stat
+import struct
+import select
+import ctypes
+import ctypes.util
 import random
+import tempfile
 from optparse import OptionParser
-from threading import Timer
+from threading import Timer, Lock, Thread, Condition, Event
+import Queue
+import multiprocessing
 import ConfigParser
 import logging
 
+#client asynchrone optionnel (asyncio pour python 2)
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+    coroutine = asyncio.coroutine
+except ImportError:
+    asyncio = None
+    coroutine = lambda function: function
+
+#scandir: os en python 3.5+, module scandir sinon (os.listdir en dernier recours)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 #mode debug
 #logging.basicConfig( format='%(levelname)s:[%(funcName)s,%(lineno)s]:%(message)s',level=logging.DEBUG)
 #mode user
 logging.basicConfig( format='%(message)s',level=logging.INFO)
 
 
-class Beta:
-    """Class utilisant l'api de Betaseries
-    Elle se focalise essentiellement sur le téléchargement des sous-titres.
+class RateLimiter:
+    """Limiteur de débit (token bucket) partagé par toutes les requêtes.
 
-    voir la doc en ligne:
-    http://sites.google.com/site/thammasprojects/betasub/module-fr
+    Respecte aussi les demandes de pause du serveur (throttle).
 
     """
-    def __init__(self, api="3c15b9796654"):
+    def __init__(self, rate=0, burst=None):
         """Initialisation des paramètres.
 
+        rate: requêtes par seconde (0 = pas de limite)
+        burst: nombre de requêtes possibles d'un coup (par défaut rate)
+
         """
-        self.api = api
-        self.api_url = "http://api.betaseries.com"
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = None
+        self.last = time.time()
+        self.paused_until = 0
+        self.lock = Lock()
+        #compteurs
+        self.waited = 0.0
 
 
 
-    def source_get(self, url):
-        """Récupère ce qui est renvoyé à partir d'une url.
+    def acquire(self):
+        """Attend, si besoin, le droit de faire une requête.
 
-        Permet également de créer l'user-agent.
+        Retourne le temps attendu en secondes.
 
         """
-        opener = urllib2.build_opener()
-        ua = 'BetaSub %s' % __version__
-        opener.addheaders = [('User-agent', ua)]
-        source = opener.open(url)
-        return source.read()
+        with self.lock:
+            now = time.time()
+            wait = max(0, self.paused_until - now)
+            if self.rate > 0:
+                capacity = self.burst or max(1, self.rate)
+                if self.tokens is None:
+                    self.tokens = capacity
+                self.tokens = min(capacity, self.tokens + (now - self.last) * self.rate)
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            self.last = now
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+
+    def throttle(self, seconds):
+        """Suspend toutes les requêtes pendant seconds (demande du serveur).
+
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
 
 
 
-    def auth(self, login, password):
-        """Retourne le token à utiliser pour les requêtes futures.
-        Identifie le membre avec son login et mot de pass sur Beteseries.
+
+
+class ValidatorStore:
+    """Validateurs HTTP (ETag, Last-Modified) et copie locale des réponses.
+
+    Permet les requêtes conditionnelles: une réponse inchangée revient en 304
+    et c'est la copie locale qui est utilisée.  Enregistré dans la base
+    sqlite de BetaSub.
+
+    """
+    def __init__(self, database='betasub.db', max_entries=5000):
+        """Initialisation des paramètres.
 
         """
-        hash_pass = hashlib.md5(password).hexdigest()
-        params = urllib.urlencode({'login': login,
-                                   'password': hash_pass,
-                                   'key': self.api})
+        self.db = database
+        self.max_entries = max_entries
 
-        url = "%s/members/auth.json?%s" % (self.api_url, params)
-        source = self.source_get(url)
-        json_data = json.loads(source)
-        try:
-            token = json_data['root']['member']['token']
-            return token
-        except:
-            for error in json_data['root']['errors']:
-                logging.error("Betaseries: %s" %json_data['root']['errors'][error]['content'])
+        database = sqlite3.connect(self.db)
+        database.execute("""CREATE TABLE IF NOT EXISTS validators (
+                            url TEXT PRIMARY KEY, etag TEXT, modified TEXT,
+                            source BLOB, time REAL)""")
+        database.commit()
+        database.close()
 
 
-    def last_subtitles(self, language="", number=""):
-        """Retourne les derniers sous-titres récupérés par BetaSeries, dans la limite de 100.
 
-        >>> last_subtitles()
-        [{ 'url': 'http://www.betaseries.com/srt/310234',
-           'source': 'addic7ed',
-           'quality': 3,
-           'language': u'VO',
-           'filename': 'Chuck - 04x14 - Chuck Versus...x.srt'},...]
+    def get(self, url):
+        """Retourne (etag, modified, source) gardés pour l'url, ou None.
 
         """
-        params = urllib.urlencode({ 'language' : language,
-                                   'number': number,
-                                   'title':"biglove",
-                                   'key': self.api})
+        database = sqlite3.connect(self.db)
+        try:
+            row = database.execute("SELECT etag, modified, source FROM validators "
+                                   "WHERE url=?", (url,)).fetchone()
+        finally:
+            database.close()
+        if row:
+            return row[0], row[1], str(row[2])
 
-        url = "%s/subtitles/last.json?%s" % (self.api_url, params)
-        source = self.source_get(url)
-        json_data = json.loads(source)
+
+
+    def set(self, url, etag, modified, source):
+        """Garde les validateurs et la réponse de l'url.
+
+        """
+        database = sqlite3.connect(self.db)
         try:
-            subtitles = json_data['root']['subtitles']
-            all_subtitles = []
-            for subtitle in subtitles:
-                all_subtitles.append(subtitles[subtitle])
-            return all_subtitles
-        except:
-            for error in json_data['root']['errors']:
-                logging.error("Betaseries: %s" %json_data['root']['errors'][error]['content'])
+            database.execute("INSERT OR REPLACE INTO validators VALUES (?,?,?,?,?)",
+                             (url, etag, modified, sqlite3.Binary(source), time.time()))
+            total = database.execute("SELECT COUNT(*) FROM validators").fetchone()[0]
+            if total > self.max_entries:
+                database.execute("""DELETE FROM validators WHERE url IN (SELECT url
+                                    FROM validators ORDER BY time LIMIT ?)""",
+                                 (total - self.max_entries,))
+            database.commit()
+        finally:
+            database.close()
 
 
 
-    def member_subtitles(self, login, password, language="vovf", view=""):
-        """Retourne la liste des sous-titres des épisodes restant à regarder du membre identifié.
 
-        >>> beta.member_subtitles('user','psw')
-        [  {'url': 'http://www.betaseries.com/srt/310234',
-            'source': 'addic7ed', 'quality': 3, 'language': u'VO',
-            'filename': 'Chuck - 04x14 - Chuck Versus...x.srt'},...]
+
+
+class HTTPPool:
+    """Pool de connexions HTTP persistantes (keep-alive).
+
+    Les connexions sont conservées par hôte et réutilisées d'un appel à
+    l'autre, ce qui évite une poignée de main TCP (et DNS) par requête.
+    Le pool est partagé par Beta et Sub, et peut être utilisé par plusieurs
+    threads.
+
+    """
+    #erreurs HTTP temporaires, la requête est refaite
+    retry_codes = [429, 500, 502, 503, 504]
+
+    def __init__(self, pool_size=4, timeout=30, rate=0, retries=3, backoff=1.0):
+        """Initialisation des paramètres.
+
+        pool_size: nombre maximum de connexions inactives gardées par hôte.
+        rate: requêtes par seconde autorisées (0 = pas de limite)
+        retries: nombre de nouvelles tentatives après une erreur temporaire
+        backoff: délai de base en secondes, doublé à chaque tentative
 
         """
-        params = urllib.urlencode({  'view' : view,
-                                    'token': self.auth(login, password),
-                                    'key': self.api})
+        self.pool_size = int(pool_size)
+        self.timeout = timeout
+        self.user_agent = 'BetaSub %s' % __version__
+        self.idle = {}          #(scheme, host, port) -> [connexions libres]
+        self.lock = Lock()
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = 120
+        self.validators = None  #ValidatorStore optionnel
+        #compteurs
+        self.opened = 0
+        self.requests = 0
+        self.retried = 0
+        self.backoff_time = 0.0
+        self.bytes_wire = 0     #octets reçus
+        self.bytes_data = 0     #octets après décompression ou copie locale
+        self.not_modified = 0
+
+
+
+    def connection(self, key):
+        """Retourne une connexion libre pour l'hôte, ou en ouvre une nouvelle.
+
+        Retourne aussi True si la connexion est réutilisée.
 
-        url = "%s/members/episodes/%s.json?%s" % (self.api_url, language, params)
-        source = self.source_get(url)
-        json_data = json.loads(source)
-        subs_listing = []
+        """
+        with self.lock:
+            free = self.idle.get(key)
+            if free:
+                return free.pop(), True
+            self.opened += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+
+
+    def release(self, key, conn):
+        """Remet une connexion dans le pool, ou la ferme si le pool est plein.
+
+        """
+        with self.lock:
+            free = self.idle.setdefault(key, [])
+            if len(free) < self.pool_size:
+                free.append(conn)
+                return
+        conn.close()
+
+
+
+    def request(self, url, headers=None, redirects=5):
+        """Exécute un GET et retourne (status, headers, response).
+
+        La réponse doit être lue entièrement puis rendue avec done().
+        Les redirections sont suivies, les erreurs HTTP lèvent urllib2.HTTPError
+        comme avec urllib2.  Les erreurs temporaires (réseau, 429, 5xx) sont
+        retentées avec un délai exponentiel; un Retry-After du serveur
+        suspend toutes les requêtes du pool.
+
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.open(url, headers, redirects)
+            except urllib2.HTTPError, error:
+                if error.code not in self.retry_codes or attempt >= self.retries:
+                    raise
+                delay = self.retry_after(error.hdrs)
+            except (httplib.HTTPException, socket.error):
+                if attempt >= self.retries:
+                    raise
+                delay = None
+            with self.lock:
+                self.retried += 1
+            if delay is not None:
+                #le serveur demande une pause: elle vaut pour toutes les requêtes
+                self.limiter.throttle(delay)
+            else:
+                #délai exponentiel avec une part aléatoire
+                delay = self.backoff * 2 ** attempt
+                delay = min(self.max_delay, delay / 2 + random.uniform(0, delay / 2))
+                with self.lock:
+                    self.backoff_time += delay
+                time.sleep(delay)
+            attempt += 1
+
+
+
+    def retry_after(self, headers):
+        """Retourne le délai en secondes demandé par l'en-tête Retry-After, ou None.
+
+        """
+        value = (headers or {}).get('retry-after')
+        if not value:
+            return None
+        if value.strip().isdigit():
+            delay = int(value)
+        else:
+            date = email.utils.parsedate_tz(value)
+            if date is None:
+                return None
+            delay = email.utils.mktime_tz(date) - time.time()
+        return min(self.max_delay, max(0, delay))
+
+
+
+    def open(self, url, headers=None, redirects=5):
+        """Une tentative de GET, voir request().
+
+        """
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        send_headers = {'User-Agent': self.user_agent,
+                        'Connection': 'keep-alive'}
+        if headers:
+            send_headers.update(headers)
+
+        self.limiter.acquire()
+        while True:
+            conn, reused = self.connection(key)
+            try:
+                conn.request('GET', path, headers=send_headers)
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                #une connexion gardée a pu être fermée par le serveur
+                if not reused:
+                    raise
+        with self.lock:
+            self.requests += 1
+        response.pool_key = key
+        response.pool_conn = conn
+        status = response.status
+        response_headers = dict(response.getheaders())
+
+        #redirections
+        if status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+            self.done(response)
+            if redirects <= 0:
+                raise urllib2.HTTPError(url, status, 'Too many redirects',
+                                        response_headers, None)
+            location = urlparse.urljoin(url, response_headers['location'])
+            return self.open(location, headers, redirects - 1)
+
+        if status >= 400:
+            self.done(response)
+            raise urllib2.HTTPError(url, status, response.reason,
+                                    response_headers, None)
+        return status, response_headers, response
+
+
+
+    def done(self, response):
+        """Termine la lecture d'une réponse et libère sa connexion.
+
+        """
         try:
-            episodes = json_data['root']['episodes']
-            for episode in episodes:
-                #for items in episodes[episode]['subs']:
-                    #subs_listing.append(episodes[episode]['subs'][items])
-                subs_listing.append(episodes[episode])
-            return subs_listing
-        except:
-            for error in json_data['root']['errors']:
-                logging.error("Betaseries: %s" %json_data['root']['errors'][error]['content'])
-            return subs_listing
+            response.read()
+        except (httplib.HTTPException, socket.error):
+            response.pool_conn.close()
+            return
+        if response.will_close:
+            response.pool_conn.close()
+        else:
+            self.release(response.pool_key, response.pool_conn)
 
 
 
-    def search_subtitles(self, show, season="", episode="", language=""):
-        """Retourne la liste des urls des épisodes à partir d'une recherche
+    def get(self, url, headers=None, revalidate=False):
+        """Retourne le contenu renvoyé par une url.
 
-        >>> beta.search_subtitles('chuck 4 14')
-        [{ 'url': 'http://www.betaseries.com/srt/310234',
-           'source': 'addic7ed',
-           'quality': 3,
-           'language': u'VO',
-           'filename': 'Chuck - 04x14 - Chuck Versus...x.srt'},...]
+        La réponse est demandée compressée (gzip).
+        revalidate: url publique dont la réponse peut être gardée avec ses
+        validateurs; la requête suivante est alors conditionnelle et une
+        réponse 304 est servie depuis la copie locale.  Jamais pour les
+        urls d'authentification ou de membre (token, mot de passe).
 
         """
-        params = urllib.urlencode({ 'language' : language,
-                                    'season': season,
-                                    'episode': episode,
-                                    'key': self.api})
+        send_headers = {'Accept-Encoding': 'gzip'}
+        stored = None
+        revalidate = revalidate and self.validators is not None
+        if revalidate:
+            stored = self.validators.get(url)
+        if stored:
+            etag, modified, source = stored
+            if etag:
+                send_headers['If-None-Match'] = etag
+            if modified:
+                send_headers['If-Modified-Since'] = modified
+        if headers:
+            send_headers.update(headers)
+
+        status, response_headers, response = self.request(url, send_headers)
+        raw = response.read()
+        self.done(response)
+        data = raw
+        if response_headers.get('content-encoding', '').lower() == 'gzip':
+            data = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+        if status == 304 and stored:
+            data = stored[2]
+            with self.lock:
+                self.not_modified += 1
+        elif revalidate and status == 200:
+            etag = response_headers.get('etag')
+            modified = response_headers.get('last-modified')
+            if etag or modified:
+                self.validators.set(url, etag, modified, data)
+        self.received(len(raw), len(data))
+        return data
+
+
+
+    def received(self, wire, data):
+        """Compte les octets reçus (wire) et les octets utiles obtenus (data).
 
-        url = "%s/subtitles/show/%s.json?%s" % (self.api_url, show, params)
-        source = self.source_get(url)
-        json_data = json.loads(source)
-        all_subtitles = []
+        """
+        with self.lock:
+            self.bytes_wire += wire
+            self.bytes_data += data
+
+
+
+    def stats(self):
+        """Retourne les compteurs du pool.
+
+        """
+        return {'requests': self.requests,
+                'opened': self.opened,
+                'retried': self.retried,
+                'backoff': self.backoff_time,
+                'waited': self.limiter.waited,
+                'bytes_wire': self.bytes_wire,
+                'bytes_data': self.bytes_data,
+                'not_modified': self.not_modified}
+
+
+
+    def close(self):
+        """Ferme toutes les connexions inactives.
+
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for free in idle.values():
+            for conn in free:
+                conn.close()
+
+
+
+
+
+
+class WorkerPool:
+    """Pool de threads borné.
+
+    imap() applique une fonction à une liste d'éléments en parallèle et
+    retourne les résultats dans l'ordre de la liste, ce qui garde des logs
+    dans un ordre déterministe.
+
+    """
+    #plafond pour ne pas surcharger l'api
+    max_workers = 8
+
+    def __init__(self, workers=1):
+        """Initialisation des paramètres.
+
+        """
+        self.workers = max(1, min(int(workers), self.max_workers))
+
+
+
+    def imap(self, function, items):
+        """Générateur des résultats de function(item), dans l'ordre des items.
+
+        Une exception levée par function est relancée au moment où son
+        résultat est atteint.
+
+        """
+        items = list(items)
+        #sans parallélisme
+        if self.workers == 1 or len(items) < 2:
+            for item in items:
+                yield function(item)
+            return
+
+        queue = Queue.Queue()
+        for num, item in enumerate(items):
+            queue.put((num, item))
+        results = {}
+        condition = Condition()
+
+        def work():
+            while True:
+                try:
+                    num, item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    result = (True, function(item))
+                except Exception:
+                    result = (False, sys.exc_info())
+                with condition:
+                    results[num] = result
+                    condition.notify_all()
+
+        for i in range(min(self.workers, len(items))):
+            thread = Thread(target=work)
+            thread.daemon = True
+            thread.start()
+
+        for num in range(len(items)):
+            with condition:
+                while num not in results:
+                    condition.wait(1)
+                success, value = results.pop(num)
+            if not success:
+                raise value[0], value[1], value[2]
+            yield value
+
+
+
+
+
+
+class TokenCache:
+    """Cache des tokens Betaseries par login, avec durée de vie.
+
+    Les tokens sont gardés en mémoire (boucle de l'updater) et enregistrés
+    dans un petit fichier si token_file est défini (lancements successifs en
+    ligne de commande).
+
+    """
+    def __init__(self, token_file=None, ttl=43200):
+        """Initialisation des paramètres.
+
+        ttl: durée de vie d'un token en secondes
+
+        """
+        self.token_file = token_file
+        self.ttl = ttl
+        self.lock = Lock()
+        self.tokens = {}        #login -> {'token', 'check', 'time'}
+        self.load()
+
+
+
+    def check(self, hash_pass):
+        """Empreinte du mot de passe, pour ne pas réutiliser un token périmé
+        si le mot de passe change.
+
+        """
+        return hashlib.sha1(hash_pass).hexdigest()
+
+
+
+    def load(self):
+        """Charge les tokens enregistrés.
+
+        """
+        if self.token_file and os.path.isfile(self.token_file):
+            try:
+                token_file = open(self.token_file, 'r')
+                try:
+                    self.tokens = json.load(token_file)
+                finally:
+                    token_file.close()
+            except (IOError, ValueError):
+                self.tokens = {}
+
+
+
+    def save(self):
+        """Enregistre les tokens (fichier lisible uniquement par l'utilisateur).
+
+        """
+        if not self.token_file:
+            return
         try:
-            subtitles = json_data['root']['subtitles']
-            for subtitle in subtitles:
-                all_subtitles.append(subtitles[subtitle])
-            return all_subtitles
-        except:
-            for error in json_data['root']['errors']:
-                logging.error("Betaseries: %s" %json_data['root']['errors'][error]['content'])
-            return all_subtitles
+            fd = os.open(self.token_file, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600)
+            token_file = os.fdopen(fd, 'w')
+            try:
+                json.dump(self.tokens, token_file)
+            finally:
+                token_file.close()
+        except (IOError, OSError):
+            logging.warning("Unable to save token in %s" % self.token_file)
 
 
 
-    def file_subtitles(self, file_path):
-        """Retourne la liste des sous-titres à partir d'un nom de fichier
+    def get(self, login, hash_pass):
+        """Retourne le token valide du login, ou None.
 
-        >>> beta.file_subtitles('d:\\series\\')
-        [{ 'url': 'http://www.betaseries.com/srt/310234',
-           'source': 'addic7ed',
-           'quality': 3,
-           'language': u'VO',
-           'filename': 'Chuck - 04x14 - Chuck Versus...x.srt'},...]
+        """
+        with self.lock:
+            item = self.tokens.get(login)
+        if (item and item['check'] == self.check(hash_pass) and
+            time.time() - item['time'] < self.ttl):
+            return item['token']
+
+
+
+    def set(self, login, hash_pass, token):
+        """Garde le token du login.
 
         """
-        #extrait le nom de fichier
-        path = os.path.split(file_path)[-1]
-        if path == "":
-            logging.info(self.info("no_file"))
-        else:
-            file_name = path
-        data = self.extract_data(file_name)
-        
-        #vérification du nom de la série
+        with self.lock:
+            self.tokens[login] = {'token': token,
+                                  'check': self.check(hash_pass),
+                                  'time': time.time()}
+            self.save()
+
+
+
+    def invalidate(self, login):
+        """Oublie le token du login (ex: refusé par l'api).
+
+        """
+        with self.lock:
+            if self.tokens.pop(login, None):
+                self.save()
+
+
+
+
+
+
+class ResponseCache:
+    """Cache des réponses de l'api, enregistré dans la base sqlite de BetaSub.
+
+    Chaque type de requête (endpoint) a sa propre durée de vie.  Le nombre
+    d'entrées est limité, les moins récemment utilisées sont supprimées.
+
+    """
+    #durée de vie en secondes par endpoint
+    ttls = {'shows/search': 7*86400,
+            'shows/display': 86400,
+            'subtitles/show': 900}
+
+    def __init__(self, database='betasub.db', max_entries=5000, ttls=None):
+        """Initialisation des paramètres.
+
+        """
+        self.db = database
+        self.max_entries = max_entries
+        self.ttls = dict(ResponseCache.ttls)
+        if ttls:
+            self.ttls.update(ttls)
+        self.lock = Lock()
+        #compteurs
+        self.hits = 0
+        self.misses = 0
+
+        database = sqlite3.connect(self.db)
+        database.execute("""CREATE TABLE IF NOT EXISTS cache (
+                            url TEXT PRIMARY KEY, endpoint TEXT, source TEXT,
+                            created REAL, accessed REAL)""")
+        database.commit()
+        database.close()
+
+
+
+    def get(self, endpoint, url):
+        """Retourne la réponse gardée pour l'url, ou None si absente ou périmée.
+
+        """
+        now = time.time()
+        database = sqlite3.connect(self.db)
         try:
-            show = data[0].lower()
-            show_list = self.show_url(show)
+            row = database.execute("SELECT source, created FROM cache WHERE url=?",
+                                   (url,)).fetchone()
+            if row and now - row[1] < self.ttls.get(endpoint, 0):
+                database.execute("UPDATE cache SET accessed=? WHERE url=?", (now, url))
+                database.commit()
+                with self.lock:
+                    self.hits += 1
+                return row[0]
+            if row:
+                database.execute("DELETE FROM cache WHERE url=?", (url,))
+                database.commit()
+        finally:
+            database.close()
+        with self.lock:
+            self.misses += 1
+
+
+
+    def set(self, endpoint, url, source):
+        """Garde la réponse, et supprime les plus anciennes si le cache est plein.
 
-            #si il y a plusieurs choix de séries on prend celui qui correspond le mieux
-            for item in show_list:
-                #test whether every element in showurl is in show
-                if set(item['url']) <= set(show):
-                    show = item['url']
-                else:
-                    show = show_list[0]['url']
+        """
+        now = time.time()
+        database = sqlite3.connect(self.db)
+        try:
+            database.execute("INSERT OR REPLACE INTO cache VALUES (?,?,?,?,?)",
+                             (url, endpoint, source, now, now))
+            total = database.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if total > self.max_entries:
+                database.execute("""DELETE FROM cache WHERE url IN (SELECT url
+                                    FROM cache ORDER BY accessed LIMIT ?)""",
+                                 (total - self.max_entries,))
+            database.commit()
+        finally:
+            database.close()
 
-            season = data[1]
-            episode = data[2]
-            return self.search_subtitles(show, season, episode)
-        except:
-            return []
 
 
+    def stats(self):
+        """Retourne les compteurs du cache.
 
+        """
+        return {'hits': self.hits, 'misses': self.misses}
 
-    def show_url(self, search_show):
-        """Retourne et vérifie l'existence du "nom url" de la série recherchée.
 
-        Cela Permet d'avoir le nom url exact de la série.
-        EXAMPLE: criminaljustice pour criminal justice
 
-        >>> beta.show_url("the office")
-        [ {u'url': u'theofficeus', u'title': u'The Office US'},
-          {u'url': u'theofficeuk', u'title': u'The Office (UK)'}]
+
+
+
+class ShowResolver:
+    """Résolution partagée des noms de séries en "nom url" Betaseries.
+
+    Chaque série n'est demandée qu'une fois par run (reset() entre deux
+    cycles), et les demandes simultanées d'une même série attendent la
+    requête déjà en cours.
+
+    """
+    def __init__(self, beta):
+        """Initialisation des paramètres.
 
         """
-        params = urllib.urlencode({ 'title' : search_show,
-                                    'key': self.api})
-        url = "%s/shows/search.json?%s" % (self.api_url, params)
-        source = self.source_get(url)
-        json_data = json.loads(source)
-        shows_listing = []
+        self.beta = beta
+        self.lock = Lock()
+        self.shows = {}         #nom normalisé -> {'url', 'title'} ou None
+        self.pending = {}       #nom normalisé -> Event de la requête en cours
+
+
+
+    def normalize(self, show):
+        """Nom de série normalisé, utilisé comme clé.
+
+        """
+        return " ".join(show.lower().split())
+
+
+
+    def resolve(self, show):
+        """Retourne la série ({'url', 'title'}) qui correspond le mieux, ou None.
+
+        Un échec de la recherche (réseau, réponse illisible) est journalisé
+        et n'est pas gardé: la série sera redemandée (voir known).
+
+        """
+        key = self.normalize(show)
+        with self.lock:
+            if key in self.shows:
+                return self.shows[key]
+            event = self.pending.get(key)
+            owner = event is None
+            if owner:
+                event = self.pending[key] = Event()
+        #une autre tâche fait déjà la requête
+        if not owner:
+            event.wait()
+            return self.resolve(show)
         try:
-            shows = json_data['root']['shows']
-            for show in shows:
-                shows_listing.append(shows[show])
-            return shows_listing
+            try:
+                item = self.beta.choose_show(key, self.beta.show_url(key))
+            #l'api n'a pas répondu, même après les nouvelles tentatives
+            except (urllib2.URLError, httplib.HTTPException, socket.error,
+                    ValueError), error:
+                logging.error("Betaseries: show lookup failed for %s (%s)" % (key, error))
+                return None
+            with self.lock:
+                self.shows[key] = item
+            return item
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+
+
+
+    def known(self, show):
+        """True si la recherche de la série a abouti (même sans résultat).
+
+        """
+        with self.lock:
+            return self.normalize(show) in self.shows
+
+
+
+    def group(self, files):
+        """Regroupe des chemins de vidéos par nom de série normalisé.
+
+        {'chuck': [path1, path2], 'the office': [path3]}
+        Les fichiers dont le nom n'est pas reconnu sont ignorés.
+
+        """
+        files = list(files)
+        data = self.beta.extract_data_many([os.path.split(f)[-1] for f in files])
+        groups = {}
+        for num, show in zip(data['index'], data['shows']):
+            groups.setdefault(self.normalize(show), []).append(files[num])
+        return groups
+
+
+
+    def reset(self):
+        """Oublie les séries déjà résolues (nouveau run).
+
+        """
+        with self.lock:
+            self.shows = {}
+
+
+
+
+
+
+class FilenameParser:
+    """Analyse des noms de fichiers et des recherches (voir Beta.extract_data).
+
+    Les regex sont compilées une seule fois, au chargement du module, et les
+    résultats sont gardés par nom dans un cache LRU borné.
+
+    """
+    #regex pour la recherche
+    pattern1 = re.compile(r"""
+          ^(?P<show>.*?)\s*                     #show
+          (                                     #season,episode
+          season?|saison?|[s .n]?(?P<season>\d+)#season
+          [e .x]?(?P<episode>\d+)?              #episode
+          )+
+          .*                                    #any before language
+          [ .]+(?P<language>fren|enfr|vovf|vfvo|fr|en|vo|vf)+? #language
+          .*?$ #end
+          """,re.IGNORECASE|re.VERBOSE)
+
+    #deuxième regex pour ceux sans langue:
+    pattern2 = re.compile(r"""
+          ^(?P<show>.*?)\s*                     #show
+          (                                     #season,episode
+          season?|saison?|[s .n]?(?P<season>\d+)#season
+          [e .x]?(?P<episode>\d+)?              #episode
+          )+
+          (?P<language>)?                       #MODIF.
+          """,re.IGNORECASE|re.VERBOSE)
+
+    #caractères inutiles
+    junk = re.compile(r'[\.\-\_\,\:\;\[\]\(\)]')
+    #dates de 2000 à 2019, supprimées en un seul passage
+    dates = re.compile(r'20[01]\d')
+    #normalisation langue
+    languages = {'fren': 'vovf', 'enfr': 'vovf', 'vfvo': 'vovf', 'vovf': 'vovf',
+                 'en': 'vo', 'vo': 'vo', 'fr': 'vf', 'vf': 'vf'}
+
+    def __init__(self, size=4096):
+        """Initialisation des paramètres.
+
+        size: nombre de résultats gardés en cache
+
+        """
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.lock = Lock()
+
+
+
+    def parse(self, value):
+        """Retourne ['show', 'season', 'episode', 'language'] ou False, avec cache.
+
+        """
+        result = self.lookup(value)
+        #copie, le résultat gardé ne doit pas être modifié
+        if result:
+            return list(result)
+        return result
+
+
+
+    def parse_many(self, values):
+        """Analyse toute une liste de noms en un appel.
+
+        Les noms identiques ne sont analysés qu'une fois.  Retourne des
+        colonnes parallèles pour les noms reconnus (index = position dans la
+        liste d'origine) et la liste des positions non reconnues:
+
+        {'index': [0, 2], 'shows': ['Chuck', 'Lost'], 'seasons': ['1', '2'],
+         'episodes': ['01', '05'], 'languages': ['', 'vf'], 'unparsed': [1]}
+
+        """
+        index, shows, seasons, episodes, languages, unparsed = [], [], [], [], [], []
+        seen = {}
+        for num, value in enumerate(values):
+            result = seen.get(value)
+            if result is None:
+                result = seen[value] = self.lookup(value)
+            if result:
+                index.append(num)
+                shows.append(result[0])
+                seasons.append(result[1])
+                episodes.append(result[2])
+                languages.append(result[3])
+            else:
+                unparsed.append(num)
+        return {'index': index, 'shows': shows, 'seasons': seasons,
+                'episodes': episodes, 'languages': languages,
+                'unparsed': unparsed}
+
+
+
+    def lookup(self, value):
+        """Résultat gardé en cache pour value (analysé si absent), sans copie.
+
+        """
+        with self.lock:
+            result = self.results.pop(value, None)
+            if result is not None:
+                #remis en dernier: le plus récemment utilisé
+                self.results[value] = result
+        if result is None:
+            result = self.extract(value)
+            with self.lock:
+                self.results[value] = result
+                if len(self.results) > self.size:
+                    self.results.popitem(last=False)
+        return result
+
+
+
+    def extract(self, value):
+        """Analyse un nom, sans cache.
+
+        """
+        #remplace les caract. inutiles
+        value = self.junk.sub(' ', value)
+        #remplace les dates
+        value = self.dates.sub('', value)
+        #solution pour premier regex, sinon regex 2
+        match = self.pattern1.match(value) or self.pattern2.match(value)
+        #si rien, retourne False
+        if not match:
+            return False
+        result = match.groupdict('')#''=defaut instead None
+
+        #accepting there is no season with 3 digits
+        season = result['season']
+        if len(season) == 3:
+            result["season"] = season[0]
+            result["episode"] = season[1:]
+        #accepting there is no season with 4 digits
+        season = result['season']
+        if len(season) >= 4:
+            result["season"] = season[0:2]
+            result["episode"] = season[2:]
+
+        show = result['show'].strip()
+        season = result['season']
+        episode = result['episode']
+        #normalisation langue
+        language = result['language'].lower()
+        language = self.languages.get(language, language)
+
+        #exceptions pour certaines séries ex: V(2009).
+        if show.lower() == 'v':
+            return  ['V (2009)', season, episode, language]
+        else:
+            return  [show, season, episode, language]
+
+
+
+
+
+
+class Beta:
+    """Class utilisant l'api de Betaseries
+    Elle se focalise essentiellement sur le téléchargement des sous-titres.
+
+    voir la doc en ligne:
+    http://sites.google.com/site/thammasprojects/betasub/module-fr
+
+    """
+    #codes d'erreurs de l'api pour un token invalide ou expiré
+    auth_errors = ['2001', '2002']
+    #analyse des noms de fichiers, partagée par toutes les instances
+    parser = FilenameParser()
+
+    def __init__(self, api="3c15b9796654", pool=None, pool_size=4,
+                 token_file=None, token_ttl=43200):
+        """Initialisation des paramètres.
+
+        pool: HTTPPool à partager (un nouveau est créé sinon)
+        token_file: fichier où garder les tokens entre deux lancements
+
+        """
+        self.api = api
+        self.api_url = "http://api.betaseries.com"
+        self.pool = pool or HTTPPool(pool_size)
+        self.tokens = TokenCache(token_file, token_ttl)
+        self.cache = None       #ResponseCache optionnel
+        self.resolver = ShowResolver(self)
+
+
+
+    def source_get(self, url, revalidate=False):
+        """Récupère ce qui est renvoyé à partir d'une url.
+
+        Passe par le pool de connexions persistantes (l'user-agent y est défini).
+        revalidate: url publique, voir HTTPPool.get.
+
+        """
+        return self.pool.get(url, revalidate=revalidate)
+
+
+
+    def cached_get(self, endpoint, url):
+        """Comme source_get, mais passe par le cache des réponses s'il existe.
+
+        Les réponses contenant des erreurs ne sont pas gardées.
+
+        """
+        if self.cache is None:
+            return self.source_get(url, revalidate=True)
+        source = self.cache.get(endpoint, url)
+        if source is None:
+            source = self.source_get(url, revalidate=True)
+            self.cache_store(endpoint, url, source)
+        return source
+
+
+
+    def cache_store(self, endpoint, url, source):
+        """Garde une réponse dans le cache, sauf si elle contient des erreurs.
+
+        """
+        try:
+            if not json.loads(source)['root'].get('errors'):
+                self.cache.set(endpoint, url, source)
+        except (ValueError, KeyError, AttributeError):
+            pass
+
+
+
+    def url(self, path, params):
+        """Construit l'url d'une requête de l'api (la clé y est ajoutée).
+
+        """
+        query = dict(params)
+        query['key'] = self.api
+        return "%s/%s?%s" % (self.api_url, path, urllib.urlencode(query))
+
+
+
+    def parse(self, json_data, *keys):
+        """Retourne json_data['root'][key1][key2]...
+
+        Si l'api a renvoyé des erreurs, elles sont loggées et None est retourné.
+
+        """
+        try:
+            value = json_data['root']
+            for key in keys:
+                value = value[key]
+            return value
+        except:
+            for error in json_data['root']['errors']:
+                logging.error("Betaseries: %s" %json_data['root']['errors'][error]['content'])
+
+
+
+    def parse_list(self, json_data, key):
+        """Comme parse, mais retourne la liste des valeurs du dictionnaire.
+
+        """
+        items = self.parse(json_data, key)
+        if items is not None:
+            return [items[item] for item in items]
+
+
+
+    def auth(self, login, password):
+        """Retourne le token à utiliser pour les requêtes futures.
+        Identifie le membre avec son login et mot de pass sur Beteseries.
+
+        """
+        hash_pass = hashlib.md5(password).hexdigest()
+        url = self.url("members/auth.json", {'login': login,
+                                             'password': hash_pass})
+        source = self.source_get(url)
+        return self.parse(json.loads(source), 'member', 'token')
+
+
+
+    def token(self, login, password):
+        """Retourne le token du membre, depuis le cache si possible.
+
+        """
+        hash_pass = hashlib.md5(password).hexdigest()
+        token = self.tokens.get(login, hash_pass)
+        if token is None:
+            token = self.auth(login, password)
+            if token:
+                self.tokens.set(login, hash_pass, token)
+        return token
+
+
+
+    def auth_failed(self, json_data):
+        """Vérifie si l'api a refusé le token.
+
+        """
+        try:
+            errors = json_data['root']['errors']
+            codes = [str(errors[error]['code']) for error in errors]
+        except (KeyError, TypeError):
+            return False
+        return bool(set(codes) & set(self.auth_errors))
+
+
+
+    def member_get(self, login, password, path, params):
+        """Requête authentifiée, retourne le json décodé.
+
+        Le token vient du cache.  Si l'api le refuse, il est invalidé et la
+        requête est refaite avec un nouveau token.
+
+        """
+        for retry in [False, True]:
+            url = self.member_url(path, params, self.token(login, password))
+            json_data = json.loads(self.source_get(url))
+            if retry or not self.auth_failed(json_data):
+                return json_data
+            self.tokens.invalidate(login)
+
+
+
+    def member_url(self, path, params, token):
+        """Construit l'url d'une requête authentifiée par token.
+
+        """
+        query = dict(params)
+        query['token'] = token
+        return self.url(path, query)
+
+
+
+    def last_subtitles(self, language="", number=""):
+        """Retourne les derniers sous-titres récupérés par BetaSeries, dans la limite de 100.
+
+        >>> last_subtitles()
+        [{ 'url': 'http://www.betaseries.com/srt/310234',
+           'source': 'addic7ed',
+           'quality': 3,
+           'language': u'VO',
+           'filename': 'Chuck - 04x14 - Chuck Versus...x.srt'},...]
+
+        """
+        url = self.url("subtitles/last.json", {'language': language,
+                                               'number': number})
+        source = self.source_get(url)
+        return self.parse_list(json.loads(source), 'subtitles')
+
+
+
+    def member_subtitles(self, login, password, language="vovf", view=""):
+        """Retourne la liste des sous-titres des épisodes restant à regarder du membre identifié.
+
+        >>> beta.member_subtitles('user','psw')
+        [  {'url': 'http://www.betaseries.com/srt/310234',
+            'source': 'addic7ed', 'quality': 3, 'language': u'VO',
+            'filename': 'Chuck - 04x14 - Chuck Versus...x.srt'},...]
+
+        """
+        json_data = self.member_get(login, password,
+                                    "members/episodes/%s.json" % language,
+                                    {'view': view})
+        return self.parse_list(json_data, 'episodes') or []
+
+
+
+    def search_subtitles(self, show, season="", episode="", language=""):
+        """Retourne la liste des urls des épisodes à partir d'une recherche
+
+        >>> beta.search_subtitles('chuck 4 14')
+        [{ 'url': 'http://www.betaseries.com/srt/310234',
+           'source': 'addic7ed',
+           'quality': 3,
+           'language': u'VO',
+           'filename': 'Chuck - 04x14 - Chuck Versus...x.srt'},...]
+
+        """
+        url = self.url("subtitles/show/%s.json" % show, {'language': language,
+                                                         'season': season,
+                                                         'episode': episode})
+        source = self.cached_get('subtitles/show', url)
+        return self.parse_list(json.loads(source), 'subtitles') or []
+
+
+
+    def file_subtitles(self, file_path):
+        """Retourne la liste des sous-titres à partir d'un nom de fichier
+
+        >>> beta.file_subtitles('d:\\series\\')
+        [{ 'url': 'http://www.betaseries.com/srt/310234',
+           'source': 'addic7ed',
+           'quality': 3,
+           'language': u'VO',
+           'filename': 'Chuck - 04x14 - Chuck Versus...x.srt'},...]
+
+        """
+        #extrait le nom de fichier
+        path = os.path.split(file_path)[-1]
+        if path == "":
+            logging.info(self.info("no_file"))
+        else:
+            file_name = path
+        data = self.extract_data(file_name)
+        
+        #vérification du nom de la série
+        try:
+            show = data[0].lower()
+            item = self.resolve_show(show)
+            if item:
+                show = item['url']
+            #recherche de la série en échec: vidéo ignorée
+            elif not self.resolver.known(show):
+                return []
+            season = data[1]
+            episode = data[2]
+            return self.search_subtitles(show, season, episode)
+        #l'api n'a pas répondu, même après les nouvelles tentatives
+        except (urllib2.URLError, httplib.HTTPException, socket.error), error:
+            logging.error("Betaseries: lookup failed for %s (%s)" % (file_name, error))
+            return []
+        except:
+            return []
+
+
+
+
+    def resolve_show(self, show):
+        """Retourne la série Betaseries ({'url', 'title'}) d'un nom de série, ou None.
+
+        Passe par le résolveur partagé: une seule requête par série et par run.
+
+        """
+        return self.resolver.resolve(show)
+
+
+
+    def choose_show(self, show, show_list):
+        """Si il y a plusieurs choix de séries, retourne celle qui correspond le mieux.
+
+        """
+        choice = None
+        for item in show_list:
+            #test whether every element in showurl is in show
+            if set(item['url']) <= set(show):
+                choice = item
+            else:
+                choice = show_list[0]
+        return choice
+
+
+
+    def show_url(self, search_show):
+        """Retourne et vérifie l'existence du "nom url" de la série recherchée.
+
+        Cela Permet d'avoir le nom url exact de la série.
+        EXAMPLE: criminaljustice pour criminal justice
+
+        >>> beta.show_url("the office")
+        [ {u'url': u'theofficeus', u'title': u'The Office US'},
+          {u'url': u'theofficeuk', u'title': u'The Office (UK)'}]
+
+        """
+        url = self.url("shows/search.json", {'title': search_show})
+        source = self.cached_get('shows/search', url)
+        #erreurs si la recherche fait moins de 2 caractères
+        return self.parse_list(json.loads(source), 'shows') or []
+
+
+
+
+    def extract_data(self, value):
+        """Extrait les infos à partir d'une recherche ou d'un nom de fichier.
+
+        Retourne une liste ['show', 'season', 'episode', 'language']
+
+        >>> beta.extract_data('Southland - 3x01 - Episode 1.HDTV.en.avi')
+        ['Southland','3','01','en']
+
+        """
+        return self.parser.parse(value)
+
+
+
+    def extract_data_many(self, values):
+        """Extrait les infos d'une liste de noms de fichiers en un appel.
+
+        Retourne des colonnes parallèles, voir FilenameParser.parse_many.
+
+        >>> beta.extract_data_many(['Chuck.S01E01.avi', 'readme', 'Lost.2x05.fr.avi'])
+        {'index': [0, 2], 'shows': ['Chuck', 'Lost'], 'seasons': ['01', '2'],
+         'episodes': ['01', '05'], 'languages': ['', 'vf'], 'unparsed': [1]}
+
+        """
+        return self.parser.parse_many(values)
+
+
+
+    def member_downloaded(self, login, password, show, season, episode):
+        """Marque l'épisode de la saison de la série url comme récupéré.
+        
+        Pour fonctionner, l'option doit être activée dans le compte du membre.
+        
+        """
+        json_data = self.member_get(login, password,
+                                    "members/downloaded/%s.json" % show,
+                                    {'season': str(season),
+                                     'episode': str(episode)})
+        return self.parse(json_data, 'downloaded')
+
+
+    def member_watched(self, login, password, show, season, episode, note=""):
+        """Marque l'épisode de la saison de la série url comme vu sur BetaSeries.
+
+
+        """
+        json_data = self.member_get(login, password,
+                                    "members/watched/%s.json" % show,
+                                    {'season': str(season),
+                                     'episode': str(episode),
+                                     'note': str(note)})
+        return self.parse(json_data, 'code')
+
+
+
+    def show_info(self, show):
+        """Retourne les informations sur la série-nom-url sous forme de dict
+
+        ex: {u'status': u'Continuing', u'id_thetvdb': u'79349', ...}
+
+        """
+        url = self.url("shows/display/%s.json" % show, {})
+        source = self.cached_get('shows/display', url)
+        return self.parse(json.loads(source), 'show')
+
+
+
+
+
+
+class AsyncBeta(Beta):
+    """Client asynchrone de l'api de Betaseries (asyncio, via trollius).
+
+    Les méthodes réseau sont des coroutines qui retournent les mêmes
+    structures que Beta.  Le nombre de requêtes en cours est limité par un
+    sémaphore.
+
+    >>> loop = asyncio.get_event_loop()
+    >>> loop.run_until_complete(AsyncBeta().show_url("the office"))
+    [ {u'url': u'theofficeus', u'title': u'The Office US'},...]
+
+    """
+    def __init__(self, api="3c15b9796654", limit=20, token_file=None,
+                 token_ttl=43200, timeout=30):
+        """Initialisation des paramètres.
+
+        limit: nombre maximum de requêtes simultanées
+
+        """
+        if asyncio is None:
+            raise ImportError("AsyncBeta needs trollius (pip install trollius)")
+        Beta.__init__(self, api, token_file=token_file, token_ttl=token_ttl)
+        self.semaphore = asyncio.Semaphore(limit)
+        self.timeout = timeout
+        self.shows = {}         #nom normalisé -> tâche de recherche (resolve_show)
+
+
+
+    @coroutine
+    def fetch(self, url):
+        """Exécute un GET (HTTP/1.0) et retourne (status, headers, data).
+
+        """
+        parts = urlparse.urlsplit(url)
+        use_ssl = parts.scheme == 'https'
+        port = parts.port or (443 if use_ssl else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        request = ("GET %s HTTP/1.0\r\nHost: %s\r\nUser-Agent: BetaSub %s\r\n"
+                   "Connection: close\r\n\r\n" % (path, parts.netloc, __version__))
+        if isinstance(request, unicode):
+            request = request.encode('utf-8')
+
+        with (yield From(self.semaphore)):
+            reader, writer = yield From(asyncio.wait_for(
+                                asyncio.open_connection(parts.hostname, port,
+                                                        ssl=use_ssl),
+                                self.timeout))
+            try:
+                writer.write(request)
+                data = yield From(asyncio.wait_for(reader.read(), self.timeout))
+            finally:
+                writer.close()
+
+        head, _, body = data.partition('\r\n\r\n')
+        lines = head.split('\r\n')
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        raise Return((status, headers, body))
+
+
+
+    @coroutine
+    def source_get(self, url, redirects=5):
+        """Récupère ce qui est renvoyé à partir d'une url.
+
+        Suit les redirections, les erreurs HTTP lèvent urllib2.HTTPError.
+
+        """
+        status, headers, data = yield From(self.fetch(url))
+        while status in (301, 302, 303, 307, 308) and 'location' in headers:
+            if redirects <= 0:
+                raise urllib2.HTTPError(url, status, 'Too many redirects',
+                                        headers, None)
+            url = urlparse.urljoin(url, headers['location'])
+            redirects -= 1
+            status, headers, data = yield From(self.fetch(url))
+        if status >= 400:
+            raise urllib2.HTTPError(url, status, httplib.responses.get(status, ''),
+                                    headers, None)
+        raise Return(data)
+
+
+
+    @coroutine
+    def cached_get(self, endpoint, url):
+        """Comme source_get, mais passe par le cache des réponses s'il existe.
+
+        """
+        source = None
+        if self.cache is not None:
+            source = self.cache.get(endpoint, url)
+        if source is None:
+            source = yield From(self.source_get(url))
+            if self.cache is not None:
+                self.cache_store(endpoint, url, source)
+        raise Return(source)
+
+
+
+    @coroutine
+    def auth(self, login, password):
+        """Retourne le token à utiliser pour les requêtes futures.
+
+        """
+        hash_pass = hashlib.md5(password).hexdigest()
+        url = self.url("members/auth.json", {'login': login,
+                                             'password': hash_pass})
+        source = yield From(self.source_get(url))
+        raise Return(self.parse(json.loads(source), 'member', 'token'))
+
+
+
+    @coroutine
+    def token(self, login, password):
+        """Retourne le token du membre, depuis le cache si possible.
+
+        """
+        hash_pass = hashlib.md5(password).hexdigest()
+        token = self.tokens.get(login, hash_pass)
+        if token is None:
+            token = yield From(self.auth(login, password))
+            if token:
+                self.tokens.set(login, hash_pass, token)
+        raise Return(token)
+
+
+
+    @coroutine
+    def member_get(self, login, password, path, params):
+        """Requête authentifiée, retourne le json décodé.
+
+        """
+        for retry in [False, True]:
+            token = yield From(self.token(login, password))
+            source = yield From(self.source_get(self.member_url(path, params, token)))
+            json_data = json.loads(source)
+            if retry or not self.auth_failed(json_data):
+                raise Return(json_data)
+            self.tokens.invalidate(login)
+
+
+
+    @coroutine
+    def last_subtitles(self, language="", number=""):
+        """Retourne les derniers sous-titres récupérés par BetaSeries.
+
+        """
+        url = self.url("subtitles/last.json", {'language': language,
+                                               'number': number})
+        source = yield From(self.source_get(url))
+        raise Return(self.parse_list(json.loads(source), 'subtitles'))
+
+
+
+    @coroutine
+    def member_subtitles(self, login, password, language="vovf", view=""):
+        """Retourne la liste des sous-titres des épisodes restant à regarder du membre.
+
+        """
+        json_data = yield From(self.member_get(login, password,
+                                               "members/episodes/%s.json" % language,
+                                               {'view': view}))
+        raise Return(self.parse_list(json_data, 'episodes') or [])
+
+
+
+    @coroutine
+    def search_subtitles(self, show, season="", episode="", language=""):
+        """Retourne la liste des sous-titres à partir d'une recherche.
+
+        """
+        url = self.url("subtitles/show/%s.json" % show, {'language': language,
+                                                         'season': season,
+                                                         'episode': episode})
+        source = yield From(self.cached_get('subtitles/show', url))
+        raise Return(self.parse_list(json.loads(source), 'subtitles') or [])
+
+
+
+    @coroutine
+    def file_subtitles(self, file_path):
+        """Retourne la liste des sous-titres à partir d'un nom de fichier.
+
+        """
+        data = self.extract_data(os.path.split(file_path)[-1])
+        try:
+            show = data[0].lower()
+            item = yield From(self.resolve_show(show))
+            if item:
+                show = item['url']
+            #recherche de la série en échec (oubliée): vidéo ignorée
+            if item or self.resolver.normalize(show) in self.shows:
+                subtitles = yield From(self.search_subtitles(show, data[1], data[2]))
+            else:
+                subtitles = []
+        except Exception:
+            subtitles = []
+        raise Return(subtitles)
+
+
+
+    @coroutine
+    def resolve_show(self, show):
+        """Coroutine: série Betaseries ({'url', 'title'}) d'un nom de série, ou None.
+
+        Remplace Beta.resolve_show, dont le ShowResolver synchrone ne peut pas
+        attendre show_url.  Une seule recherche par série: les tâches
+        simultanées attendent la même.  Un échec est journalisé et oublié.
+
+        """
+        key = self.resolver.normalize(show)
+        task = self.shows.get(key)
+        if task is None:
+            task = self.shows[key] = asyncio.ensure_future(self.choose_show_url(key))
+        try:
+            item = yield From(task)
+        #l'api n'a pas répondu, même après les nouvelles tentatives
+        except (urllib2.URLError, httplib.HTTPException, socket.error,
+                ValueError, asyncio.TimeoutError), error:
+            if self.shows.get(key) is task:
+                del self.shows[key]
+                logging.error("Betaseries: show lookup failed for %s (%s)" % (key, error))
+            raise Return(None)
+        raise Return(item)
+
+
+
+    @coroutine
+    def choose_show_url(self, show):
+        """Recherche la série et retourne celle qui correspond le mieux, ou None.
+
+        """
+        show_list = yield From(self.show_url(show))
+        raise Return(self.choose_show(show, show_list))
+
+
+
+    @coroutine
+    def show_url(self, search_show):
+        """Retourne et vérifie l'existence du "nom url" de la série recherchée.
+
+        """
+        url = self.url("shows/search.json", {'title': search_show})
+        source = yield From(self.cached_get('shows/search', url))
+        raise Return(self.parse_list(json.loads(source), 'shows') or [])
+
+
+
+    @coroutine
+    def member_downloaded(self, login, password, show, season, episode):
+        """Marque l'épisode de la saison de la série url comme récupéré.
+
+        """
+        json_data = yield From(self.member_get(login, password,
+                                               "members/downloaded/%s.json" % show,
+                                               {'season': str(season),
+                                                'episode': str(episode)}))
+        raise Return(self.parse(json_data, 'downloaded'))
+
+
+
+    @coroutine
+    def member_watched(self, login, password, show, season, episode, note=""):
+        """Marque l'épisode de la saison de la série url comme vu sur BetaSeries.
+
+        """
+        json_data = yield From(self.member_get(login, password,
+                                               "members/watched/%s.json" % show,
+                                               {'season': str(season),
+                                                'episode': str(episode),
+                                                'note': str(note)}))
+        raise Return(self.parse(json_data, 'code'))
+
+
+
+    @coroutine
+    def show_info(self, show):
+        """Retourne les informations sur la série-nom-url sous forme de dict.
+
+        """
+        url = self.url("shows/display/%s.json" % show, {})
+        source = yield From(self.cached_get('shows/display', url))
+        raise Return(self.parse(json.loads(source), 'show'))
+
+
+
+    @coroutine
+    def download_file(self, file_name, file_url, directory):
+        """Télécharge les sous-titres dans le répertoire indiqué.
+
+        """
+        if os.path.isdir(directory):
+            logging.info(file_name)
+            data = yield From(self.source_get(file_url))
+            sub = open(os.path.join(directory, file_name), "wb")
+            try:
+                sub.write(data)
+            finally:
+                sub.close()
+        else:
+            logging.critical("error: directory do not exist.")
+            raise Return(False)
+
+
+
+
+
+
+class Sub:
+    """Class fournissant des outils pour les sous-titres
+
+    """
+    #signatures d'une archive zip
+    zip_magic = ('PK\x03\x04', 'PK\x05\x06')
+
+    #taille des blocs copiés lors de l'extraction
+    chunk_size = 64*1024
+
+    def __init__(self, pool=None, spool_size=4*1024*1024, max_member_size=2048*1024):
+        """Initialisation des paramètres.
+
+        pool: HTTPPool à partager avec Beta (un nouveau est créé sinon)
+        spool_size: au-delà, un téléchargement passe de la mémoire à un fichier temporaire
+        max_member_size: taille maximale d'un fichier extrait d'un zip (0 = sans limite)
+
+        """
+        self.pool = pool or HTTPPool()
+        self.spool_size = spool_size
+        self.max_member_size = max_member_size
+
+    def download_file(self, file_name, file_url, directory):
+        """Télécharge les sous-titres dans le répertoire indiqué
+
+        """
+        if os.path.isdir(directory) :
+            logging.info(file_name)
+            status, headers, response = self.pool.request(file_url)
+            sub = open(os.path.join(directory, file_name), "wb")
+            try:
+                shutil.copyfileobj(response, sub)
+            finally:
+                size = sub.tell()
+                sub.close()
+                self.pool.done(response)
+                self.pool.received(size, size)
+
+        else:
+            # message d'avertissement
+            logging.critical("error: directory do not exist.")
+            return False
+
+
+
+    def fetch_file(self, file_url):
+        """Télécharge une url dans un tampon en mémoire, retourne le tampon.
+
+        Le tampon ne passe sur le disque (fichier temporaire) qu'au-delà de
+        spool_size octets.
+
+        """
+        buffer = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        status, headers, response = self.pool.request(file_url)
+        try:
+            shutil.copyfileobj(response, buffer)
+        finally:
+            self.pool.done(response)
+        size = buffer.tell()
+        self.pool.received(size, size)
+        buffer.seek(0)
+        return buffer
+
+
+
+    def download_subtitle(self, file_name, file_url, directory, unzip=False,
+                          file_filter=None):
+        """Télécharge un sous-titre et, si c'est un zip, l'extrait directement.
+
+        Aucun fichier intermédiaire: une archive est lue depuis le tampon du
+        téléchargement et seuls ses sous-titres sont écrits.  Sans unzip,
+        le fichier est écrit tel quel.
+        Retourne la liste des sous-titres obtenus (vide pour un zip gardé).
+
+        """
+        if not os.path.isdir(directory):
+            # message d'avertissement
+            logging.critical("error: directory do not exist.")
+            return []
+        return self.store_subtitle(self.fetch_file(file_url), file_name,
+                                   directory, unzip, file_filter)
+
+
+
+    def store_subtitle(self, buffer, file_name, directory, unzip=False,
+                       file_filter=None):
+        """Écrit un sous-titre déjà téléchargé (tampon de fetch_file).
+
+        Un zip est extrait depuis le tampon si unzip, sinon le fichier est
+        écrit tel quel.  Le tampon est fermé.
+        Retourne la liste des sous-titres obtenus (vide pour un zip gardé).
+
+        """
+        if not os.path.isdir(directory):
+            buffer.close()
+            logging.critical("error: directory do not exist.")
+            return []
+        logging.info(file_name)
+        try:
+            is_zip = buffer.read(4) in self.zip_magic
+            buffer.seek(0)
+            if is_zip and unzip:
+                try:
+                    return self.extract_zip(buffer, directory, file_filter)
+                except zipfile.BadZipfile:
+                    logging.error("Bad zip file: %s" % file_name)
+                    return []
+            #on écrit le fichier tel quel
+            file_path = os.path.join(directory, file_name)
+            sub = open(file_path, "wb")
+            try:
+                shutil.copyfileobj(buffer, sub)
+            finally:
+                sub.close()
+            if is_zip:
+                return []
+            return [file_path]
+        finally:
+            buffer.close()
+
+
+
+    def unzip_file(self, zip_file, directory, file_filter=None):
+        """Unzip subs from subtitles folder with filter (FileFilter).
+        Return a list of the unzipped files
+
+        """
+        #seulement si l'archive est valide
+        if zipfile.is_zipfile(zip_file):
+            return_list = self.extract_zip(zip_file, directory, file_filter)
+            # efface le zip
+            os.remove(zip_file)
+            #retour de la liste des fichiers dézipper
+            return return_list
+        else:
+            #retour de la liste des fichiers qui ne sont pas des zip
+            return [zip_file]
+
+
+
+    def extract_zip(self, zip_file, directory, file_filter=None):
+        """Extrait les sous-titres d'une archive (chemin ou fichier ouvert).
+        Return a list of the unzipped files
+
+        Chaque fichier est copié par blocs de chunk_size: la mémoire reste
+        la même quelle que soit la taille de l'archive.  Un fichier dont la
+        taille annoncée dépasse max_member_size est ignoré sans être
+        décompressé.  file_filter (FileFilter) écarte les fichiers filtrés.
+        Chaque fichier est écrit sous un nom temporaire puis renommé: deux
+        archives du même dossier extraites en parallèle ne mélangent ni
+        n'effacent leurs fichiers; pour un même nom, l'un des deux, complet,
+        est gardé.
+
+        """
+        #on crée une liste qui sera retournée à la fin
+        return_list = []
+        zip_data = zipfile.ZipFile(zip_file, 'r')
+        try:
+            for info in self.zip_members(zip_data, file_filter):
+                #on transforme le chemin des sous-dossier en dossier commun
+                sub_path = os.path.join(directory, info.filename.split("/")[-1])
+                #on évite les dossier
+                if os.path.isdir(sub_path): continue
+                temp = self.temp_file(sub_path)
+                try:
+                    if self.extract_member(zip_data, info, temp):
+                        self.replace_file(temp, sub_path)
+                        #on crée la liste des fichiers de retour
+                        return_list.append(sub_path)
+                finally:
+                    if os.path.exists(temp):
+                        os.remove(temp)
+        finally:
+            zip_data.close()
+        return return_list
+
+
+
+    def zip_members(self, zip_data, file_filter=None):
+        """Générateur des fichiers d'une archive à extraire (ZipInfo).
+
+        Les dossiers, les fichiers filtrés et ceux dont la taille annoncée
+        dépasse max_member_size sont écartés, sans rien décompresser.
+
+        """
+        for info in zip_data.infolist():
+            subs = info.filename
+            #on évite les dossier
+            if subs.endswith("/"):
+                continue
+            # si n'échappe pas aux filtres
+            if file_filter is not None and file_filter.rejects(subs, info.file_size):
+                continue
+            #taille annoncée trop grande: on ne décompresse pas
+            if self.max_member_size and info.file_size > self.max_member_size:
+                logging.warning("%s skipped, too big (%s bytes)" % (subs, info.file_size))
+                continue
+            yield info
+
+
+
+    def extract_member(self, zip_data, info, sub_path):
+        """Copie un fichier de l'archive vers sub_path, par blocs.
+
+        La copie s'arrête (et le fichier est effacé) si le contenu dépasse
+        max_member_size malgré la taille annoncée.
+        Retourne True si le fichier est écrit.
+
+        """
+        member = zip_data.open(info)
+        try:
+            sub = open(sub_path, "wb")
+            try:
+                size = 0
+                while True:
+                    data = member.read(self.chunk_size)
+                    if not data:
+                        return True
+                    size += len(data)
+                    if self.max_member_size and size > self.max_member_size:
+                        break
+                    sub.write(data)
+            finally:
+                sub.close()
+        finally:
+            member.close()
+        #taille annoncée fausse
+        logging.warning("%s skipped, bigger than announced" % info.filename)
+        os.remove(sub_path)
+        return False
+
+
+
+    def temp_file(self, destination):
+        """Crée un fichier temporaire caché à côté de destination
+        (même système de fichiers, donc renommable en destination).
+
+        Pas de mkstemp: son mode 0600 passerait au fichier placé, illisible
+        pour un serveur média sous un autre compte.  Ici, 0666 moins umask.
+
+        """
+        directory, name = os.path.split(destination)
+        while True:
+            #pid: les processus de mode_unzip héritent du même état de random
+            temp = os.path.join(directory or '.', '.%s.%d.%08x.part'
+                                % (name, os.getpid(), random.getrandbits(32)))
+            try:
+                fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+            except OSError, e:
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+            os.close(fd)
+            return temp
+
+
+
+    def replace_file(self, source, destination):
+        """Renomme source en destination, en écrasant destination.
+
+        os.rename est atomique sous posix; sous Windows il échoue si
+        destination existe, on l'efface alors d'abord.
+
+        """
+        try:
+            os.rename(source, destination)
+        except OSError:
+            if os.name != 'nt' or not os.path.exists(destination):
+                raise
+            os.remove(destination)
+            os.rename(source, destination)
+
+
+
+    def files_list(self, directory, extensions=['avi','mkv','mp4'], subfolders=False):
+        """Return all files list from directory.
+        Possibility to add extensions list and subfolders
+
+        """
+        all_files = [entry['path'] for entry in self.scan(directory, extensions, subfolders)]
+        # Si il y a au moins un fichier
+        if all_files:
+            return all_files
+
+        else:
+            logging.info("No file.")
+            return []
+
+
+
+    def scan(self, directory, extensions=['avi','mkv','mp4'], subfolders=False):
+        """Générateur des fichiers de directory dont l'extension est dans
+        extensions (sans tenir compte de la casse).
+
+        Chaque dossier n'est lu qu'une fois.  Retourne des dict
+        {path, size, mtime}; les sous-dossiers sont parcourus après les
+        fichiers du dossier, comme os.walk (dossiers cachés compris).
+        Seuls les fichiers dont l'extension convient sont "stat"és.
+
+        """
+        extensions = set(ext.lower().lstrip('.') for ext in extensions)
+        recurse = subfolders == True or subfolders == "True"
+        folders = [directory]
+        while folders:
+            folder = folders.pop(0)
+            subdirs = []
+            for name, path, is_dir, get_stat in self.list_dir(folder):
+                #fichiers cachés ignorés, comme avec glob
+                if (not name.startswith('.') and
+                    os.path.splitext(name)[1][1:].lower() in extensions):
+                    try:
+                        info = get_stat()
+                    except OSError:
+                        continue
+                    if not stat.S_ISDIR(info.st_mode):
+                        yield {'path': path, 'size': info.st_size, 'mtime': info.st_mtime}
+                        continue
+                if recurse and is_dir():
+                    subdirs.append(path)
+            folders[:0] = subdirs
+
+
+
+    def list_dir(self, folder):
+        """Liste un dossier en une lecture: (name, path, is_dir(), stat()).
+
+        is_dir() ne suit pas les liens symboliques (comme os.walk): un lien
+        vers un dossier parent ne fait pas boucler le parcours.
+
+        """
+        try:
+            if scandir is not None:
+                entries = list(scandir(folder))
+            else:
+                entries = os.listdir(folder)
+        except OSError:
+            logging.warning("can't read %s" % folder)
+            return []
+        if scandir is not None:
+            return [(entry.name, os.path.join(folder, entry.name),
+                     lambda entry=entry: entry.is_dir(follow_symlinks=False), entry.stat)
+                    for entry in entries]
+        #sans scandir: rien n'est lu tant que scan ne le demande pas
+        listing = []
+        for name in entries:
+            path = os.path.join(folder, name)
+            listing.append((name, path,
+                            lambda path=path: os.path.isdir(path) and not os.path.islink(path),
+                            lambda path=path: os.stat(path)))
+        return listing
+
+
+
+
+
+
+
+
+
+
+class SubtitleIndex:
+    """Index des sous-titres déjà présents: {dossier: noms de vidéo}.
+
+    'Show.S01E01.fr.srt' compte pour la vidéo 'Show.S01E01' (extensions
+    srt, ass et sub, suffixes de langue).  La présence d'un sous-titre se
+    vérifie sans parcourir de liste.
+
+    """
+    extensions = ['srt', 'ass', 'sub']
+    #suffixes retirés en fin de nom (au plus deux: .fr.forced)
+    tags = re.compile(r"\.(?:[a-z]{2}(?:[-_][a-z]{2})?|fre|fra|eng|ger|deu|spa|ita|"
+                      r"vf|vo|vff|vfq|vf2|vostfr|french|english|forced|hi|sdh)$",
+                      re.IGNORECASE)
+
+    def __init__(self, scanner=None):
+        """Initialisation des paramètres.
+
+        scanner: objet avec scan() (Sub), pour lister les dossiers
+
+        """
+        self.scanner = scanner or Sub()
+        self.folders = {}
+
+
+
+    def key(self, folder):
+        """Clé d'un dossier (chemin normalisé).
+
+        """
+        return os.path.normcase(os.path.normpath(folder))
+
+
+
+    def add(self, path):
+        """Ajoute un fichier sous-titre à l'index.
+
+        """
+        folder, name = os.path.split(path)
+        stem = os.path.splitext(name)[0]
+        stems = self.folders.setdefault(self.key(folder), set())
+        stems.add(stem.lower())
+        for i in range(2):
+            stem, count = self.tags.subn("", stem)
+            if not count:
+                break
+            stems.add(stem.lower())
+
+
+
+    def scan(self, directory, subfolders=False):
+        """Ajoute les sous-titres de directory (une lecture par dossier).
+
+        """
+        self.folders.setdefault(self.key(directory), set())
+        for entry in self.scanner.scan(directory, self.extensions, subfolders):
+            self.add(entry['path'])
+
+
+
+    def has(self, folder, name, scan=False):
+        """True si folder contient un sous-titre pour la vidéo name (sans extension).
+
+        scan: lit folder s'il n'est pas encore dans l'index (une seule fois)
+
+        """
+        key = self.key(folder)
+        if key not in self.folders:
+            if not scan:
+                return False
+            if os.path.isdir(folder):
+                self.scan(folder)
+            else:
+                self.folders[key] = set()
+        return name.lower() in self.folders[key]
+
+
+
+
+
+
+
+
+
+
+class SubtitleRanker:
+    """Classe les sous-titres candidats pour une vidéo.
+
+    Le nom de la vidéo est découpé une fois.  Un candidat est noté de 0 à 1
+    sur l'épisode (SxxEyy, 1x02), le groupe de release, les tags
+    source/résolution et les mots en commun.  Épisode et groupe sont vérifiés
+    d'abord et donnent une borne haute qui évite le calcul complet pour les
+    candidats qui ne peuvent plus gagner (packs de saison).
+
+    """
+    french = re.compile(r".*(\.FR|\.VF)", re.IGNORECASE)
+    words = re.compile(r"[^a-z0-9]+")
+    episode = re.compile(r"(?<![a-z0-9])s(\d{1,2})e(\d{1,3})|(?<![a-z0-9])(\d{1,2})x(\d{2,3})(?![a-z0-9])")
+    release_tags = set(['hdtv', 'pdtv', 'web', 'webrip', 'webdl', 'dl', 'bluray', 'brrip',
+                        'bdrip', 'dvdrip', 'hdrip', 'xvid', 'divx', 'x264', 'h264', 'x265',
+                        'hevc', '480p', '576p', '720p', '1080p', '1080i', '2160p',
+                        'proper', 'repack', 'internal', 'aac', 'ac3', 'dd5'])
+    #seuls ces fichiers peuvent être retenus (pas les .txt, .nfo des zips)
+    extensions = set(['srt', 'ass', 'ssa', 'sub', 'vtt', 'smi'])
+    #poids: épisode, groupe, tags, mots
+    default_weights = (0.4, 0.2, 0.2, 0.2)
+
+    def __init__(self, movie_name):
+        """Découpe le nom de la vidéo (sans extension).
+
+        """
+        lower = movie_name.lower()
+        self.tokens = self.tokenize(lower)
+        self.tags = self.tokens & self.release_tags
+        self.number = self.episode_number(lower)
+        group = re.search(r"-([A-Za-z0-9]+)(?:\[[^\]]*\])?$", movie_name)
+        self.group = None
+        if group and group.group(1).lower() not in self.release_tags:
+            self.group = re.compile(r"(?<![a-z0-9])%s(?![a-z0-9])" % re.escape(group.group(1).lower()))
+        #poids ramenés à 1 selon ce que le nom de la vidéo contient
+        weights = [weight if present else 0 for weight, present in
+                   zip(self.default_weights, [self.number, self.group, self.tags, True])]
+        total = float(sum(weights))
+        self.weights = [weight / total for weight in weights]
+
+
+
+    def tokenize(self, name):
+        """Ensemble des mots d'un nom (en minuscules).
+
+        """
+        return set(token for token in self.words.split(name) if token)
+
+
+
+    def episode_number(self, name):
+        """(saison, épisode) trouvé dans un nom en minuscules, ou None.
+
+        """
+        found = self.episode.search(name)
+        if found is None:
+            return None
+        season, episode = found.group(1, 2) if found.group(1) else found.group(3, 4)
+        return int(season), int(episode)
+
 
-        #warnings si la recherche fait moin de de 2 caractères, il y a erreurs
-        except:
-            for error in json_data['root']['errors']:
-                logging.error("Betaseries: %s" %json_data['root']['errors'][error]['content'])
-            return shows_listing
 
+    def ratio(self, name, floor=0):
+        """Ressemblance entre 0 et 1; retourne -1 si elle ne peut pas
+        atteindre floor (borne haute).
 
+        """
+        lower = name.lower()
+        episode_weight, group_weight, tags_weight, words_weight = self.weights
+        score = 0
+        bound = 1
+        if self.number is not None:
+            number = self.episode_number(lower)
+            #un autre épisode (pack de saison) n'est jamais retenu
+            if number is not None and number != self.number:
+                return -1
+            if number == self.number:
+                score += episode_weight
+            else:
+                bound -= episode_weight
+        if self.group is not None:
+            if self.group.search(lower):
+                score += group_weight
+            else:
+                bound -= group_weight
+        if bound < floor:
+            return -1
+        tokens = self.tokenize(lower)
+        if self.tags:
+            score += tags_weight * len(tokens & self.tags) / float(len(self.tags))
+        if tokens or self.tokens:
+            score += words_weight * 2 * len(tokens & self.tokens) / float(len(tokens) + len(self.tokens))
+        return score
 
 
-    def extract_data(self, value):
-        """Extrait les infos à partir d'une recherche ou d'un nom de fichier.
 
-        Retourne une liste ['show', 'season', 'episode', 'language']
+    def best(self, candidates):
+        """Retourne le chemin gagnant parmi [(path, name, quality), ...], ou None.
 
-        >>> beta.extract_data('Southland - 3x01 - Episode 1.HDTV.en.avi')
-        ['Southland','3','01','en']
+        Même règle que best_subtitle: dans l'ordre, un candidat remplace le
+        gagnant si sa qualité et sa ressemblance sont au moins aussi hautes.
 
         """
-        #regex pour la recherche
-        pattern1 = re.compile(r"""
-              ^(?P<show>.*?)\s*                     #show
-              (                                     #season,episode
-              season?|saison?|[s .n]?(?P<season>\d+)#season
-              [e .x]?(?P<episode>\d+)?              #episode
-              )+
-              .*                                    #any before language
-              [ .]+(?P<language>fren|enfr|vovf|vfvo|fr|en|vo|vf)+? #language
-              .*?$ #end
-              """,re.IGNORECASE|re.VERBOSE)
-        
-        #deuxième regex pour ceux sans langue:
-        pattern2 = re.compile(r"""
-              ^(?P<show>.*?)\s*                     #show
-              (                                     #season,episode
-              season?|saison?|[s .n]?(?P<season>\d+)#season
-              [e .x]?(?P<episode>\d+)?              #episode
-              )+
-              (?P<language>)?                       #MODIF.
-              """,re.IGNORECASE|re.VERBOSE)
-        #remplace les caract. inutiles
-        value = re.sub('[\.\-\_\,\:\;\[\]\(\)]',' ',value)
-        #remplace les dates
-        for date in range(2000, 2020):
-          value = value.replace(str(date), '')
-        #solution pour premier regex
-        pattern1 = re.match(pattern1,value)
-        #autre possibilité pour regex 2
-        pattern2 = re.match(pattern2,value)
-        #si correspondant à regex 1:
-        if pattern1:
-            result = pattern1.groupdict('')#''=defaut instead None
-        #si correspondant à regex 2:
-        elif pattern2:
-            result = pattern2.groupdict('')
-        #si rien, retourne l'original ou False, pas encore décidé...
-        #... cela dépend du mode search
-        else:
-            #return value
-            #logging.debug(value)
-            return False
-        #accepting there is no season with 3 digits
-        season = result['season']
-        if len(season) == 3:
-            result["season"] = season[0]
-            result["episode"] = season[1:]
-        #accepting there is no season with 4 digits
-        season = result['season']
-        if len(season) >= 4:
-            result["season"] = season[0:2]
-            result["episode"] = season[2:]
+        score = 0
+        quality = 0
+        winner = None
+        for path, name, sub_quality in candidates:
+            if not sub_quality >= quality:
+                continue
+            ratio = self.ratio(name, score)
+            if ratio >= score:
+                score = ratio
+                quality = sub_quality
+                winner = path
+        return winner
 
-        show = result['show'].strip()
-        season = result['season']
-        episode = result['episode']
-        #normalisation langue
-        language = result['language'].lower()
-        language = re.sub('fren|enfr|vfvo','vovf',language)
-        language = re.sub('en','vo',language)
-        language = re.sub('fr','vf',language)
-        #solution finale
-        
-        #exceptions pour certaines séries ex: V(2009).
-        if show.lower() == 'v':
-            return  ['V (2009)', season, episode, language]
-        else:
-            return  [show, season, episode, language]
 
 
 
-            
 
-    def member_downloaded(self, login, password, show, season, episode):
-        """Marque l'épisode de la saison de la série url comme récupéré.
-        
-        Pour fonctionner, l'option doit être activée dans le compte du membre.
-        
-        """
-        params = urllib.urlencode({  'season' : str(season),
-                                    'episode': str(episode),
-                                    'token': self.auth(login, password),
-                                    'key': self.api})
 
 
-        url = "%s/members/downloaded/%s.json?%s" % (self.api_url, show, params)
-        source = self.source_get(url)
-        json_data = json.loads(source)
-        try:
-            downloaded = json_data['root']['downloaded']
-            return downloaded
 
-        except:
-            for error in json_data['root']['errors']:
-                logging.error("Betaseries: %s" %json_data['root']['errors'][error]['content'])
-                
-                
-    def member_watched(self, login, password, show, season, episode, note=""):
-        """Marque l'épisode de la saison de la série url comme vu sur BetaSeries.
 
 
-        """
-        params = urllib.urlencode({  'season' : str(season),
-                                    'episode': str(episode),
-                                    'note'   : str(note),
-                                    'token': self.auth(login, password),
-                                    'key': self.api})
+class FileFilter:
+    """Filtres de fichiers compilés une fois par lancement.
 
+    Utilisé pour l'extraction des zips et pour le mode filter.  Un fichier
+    est filtré si son nom correspond à exclude, ne correspond pas à include
+    (si donné), ou si sa taille est hors de [min_size, max_size].
+    Les regex portent sur le nom du fichier, ou sur le chemin avec match_path.
 
-        url = "%s/members/watched/%s.json?%s" % (self.api_url, show, params)
-        source = self.source_get(url)
-        json_data = json.loads(source)
-        try:
-            watched = json_data['root']['code']
-            return watched
+    """
+    def __init__(self, exclude="", include="", extensions=None, match_path=False,
+                 min_size=0, max_size=0, batch=200):
+        """Initialisation des paramètres.
 
-        except:
-            for error in json_data['root']['errors']:
-                logging.error("Betaseries: %s" %json_data['root']['errors'][error]['content'])
+        extensions: extensions concernées par le mode filter
+        min_size, max_size: en octets (0 = pas de règle)
+        batch: nombre de fichiers effacés à la fois
 
-                
+        """
+        self.exclude = re.compile(exclude) if exclude else None
+        self.include = re.compile(include) if include else None
+        self.extensions = [ext for ext in (extensions or []) if ext]
+        self.match_path = match_path == True or match_path == "True"
+        self.min_size = int(min_size)
+        self.max_size = int(max_size)
+        self.batch = batch
 
-    def show_info(self, show):
-        """Retourne les informations sur la série-nom-url sous forme de dict
 
-        ex: {u'status': u'Continuing', u'id_thetvdb': u'79349', ...}
+
+    def rejects(self, path, size=None):
+        """True si le fichier (chemin ou nom dans une archive) est filtré.
 
         """
-        params = urllib.urlencode({'key': self.api})
-        url = "%s/shows/display/%s.json?%s" % (self.api_url, show, params)
-        source = self.source_get(url)
-        json_data = json.loads(source)
-        try:
-            show = json_data['root']['show']
-            return show
-        except:
-            for error in json_data['root']['errors']:
-                logging.error("Betaseries: %s" %json_data['root']['errors'][error]['content'])
+        name = path if self.match_path else path.replace("\\", "/").split("/")[-1]
+        if self.exclude is not None and self.exclude.search(name) is not None:
+            return True
+        if self.include is not None and self.include.search(name) is None:
+            return True
+        if size is not None:
+            if self.min_size and size < self.min_size:
+                return True
+            if self.max_size and size > self.max_size:
+                return True
+        return False
 
 
 
+    def select(self, entries):
+        """Générateur des entrées de Sub.scan() qui sont filtrées.
 
+        """
+        for entry in entries:
+            if self.rejects(entry['path'], entry['size']):
+                yield entry
 
 
-class Sub:
-    """Class fournissant des outils pour les sous-titres
 
-    """
-    def __init__(self):
-        """Initialisation des paramètres.
+    def delete(self, entries, dry_run=False):
+        """Efface les entrées par lots de batch, retourne (nombre, octets, erreurs).
+
+        Avec dry_run, les fichiers sont seulement listés.
 
         """
+        count = size = errors = 0
+        batch = []
+        for entry in itertools.chain(entries, [None]):
+            if entry is not None:
+                batch.append(entry)
+                if len(batch) < self.batch:
+                    continue
+            for item in batch:
+                if not dry_run:
+                    try:
+                        os.remove(item['path'])
+                    except OSError, error:
+                        logging.error("%s: %s" % (item['path'], error))
+                        errors += 1
+                        continue
+                count += 1
+                size += item['size']
+                logging.info(os.path.basename(item['path']))
+            batch = []
+        return count, size, errors
 
-    def download_file(self, file_name, file_url, directory):
-        """Télécharge les sous-titres dans le répertoire indiqué
 
-        """
-        if os.path.isdir(directory) :
-            logging.info(file_name)
-            urllib.urlretrieve(file_url, directory+file_name)
 
-        else:
-            # message d'avertissement
-            logging.critical("error: directory do not exist.")
-            return False
 
 
 
-    def unzip_file(self, zip_file, directory,  use_filter=False, filters_regex=""):
-        """Unzip subs from subtitles folder with filter pattern.
-        Return a list of the unzipped files
 
-        """
-        #on crée une liste qui sera retournée à la fin
-        return_list = []
-        #si pas de regex, on désactive les filtres
-        if filters_regex == "":
-            use_filter = False
-        #seulement si l'archive est valide
-        if zipfile.is_zipfile(zip_file):
-            zip_data = zipfile.ZipFile(zip_file, 'r')
-            for subs in zip_data.namelist():
-                # si utilisation des filtres
-                if use_filter == True or use_filter == "True":
-                    # si échappent au filtres
-                    if re.search(filters_regex, subs) == None:
-                        #on ouvre le sous-titres en mémoire
-                        data = zip_data.read(subs, directory)
-                        #on transforme le chemin des sous-dossier en dossier commun
-                        sub_path = os.path.join(directory, subs.split("/")[-1])
-                        #on évite les dossier
-                        if os.path.isdir(sub_path): continue
-                        #on écrit les fichiers
-                        sub = open(sub_path, "wb")
-                        sub.write(data)
-                        sub.close()
-                        #on crée la liste des fichiers de retour
-                        return_list.append(sub_path)
-                #Si on utilise pas les filtres
-                else:
-                    #on ouvre le sous-titres en mémoire
-                    data = zip_data.read(subs, directory)
-                    #on transforme le chemin des sous-dossier en dossier commun
-                    sub_path = os.path.join(directory, subs.split("/")[-1])
-                    #on évite les dossier
-                    if os.path.isdir(sub_path): continue
-                    #on écrit les fichiers
-                    sub = open(sub_path, "wb")
-                    sub.write(data)
-                    sub.close()
-                    #on crée la liste des fichiers de retour
-                    return_list.append(sub_path)
-            zip_data.close()
-            # efface le zip
-            os.remove(zip_file)
-            #retour de la liste des fichiers dézipper
-            return return_list
-        else:
-            return_list.append(zip_file)
-            #retour de la liste des fichiers qui ne sont pas des zip
-            return return_list
 
 
-    def files_list(self, directory, extensions=['avi','mkv','mp4'], subfolders=False):
-        """Return all files list from directory.
-        Possibility to add extensions list and subfolders
 
-        """
-        all_files = []
-        #si on veut les sous-dossiers
-        if subfolders == True:
-            for root, dirs, names in os.walk(directory):
-                subdir = os.path.join(root,"")
-                for ext in extensions:
-                    for files in glob.glob(subdir+'*.%s' % ext):
-                        all_files.append(files)
-        else:
-            for ext in extensions:
-                for files in glob.glob(directory+'*.%s' % ext):
-                    all_files.append(files)
-        # Si il y a au moins un fichier
-        if all_files:
-            return all_files
+def unzip_archive(task):
+    """Extrait une archive du mode unzip (tourne dans un processus du pool).
 
-        else:
-            logging.info("No file.")
-            return []
+    task = (zip_file, file_filter, max_member_size)
+    Retourne (zip_file, liste des fichiers extraits, erreur ou None): une
+    archive invalide n'arrête pas les autres.
+
+    """
+    zip_file, file_filter, max_member_size = task
+    try:
+        if not zipfile.is_zipfile(zip_file):
+            return zip_file, [], "not a valid zip"
+        sub = Sub(max_member_size=max_member_size)
+        files = sub.unzip_file(zip_file, os.path.dirname(zip_file), file_filter)
+        return zip_file, files, None
+    except Exception, error:
+        return zip_file, [], "%s: %s" % (error.__class__.__name__, error)
 
 
 
@@ -536,7 +2391,12 @@ class Program:
                   default_directory="", extensions_filter_mode="srt|txt|ass",
                   subtitles_directory="", use_quotes=True,
                   quality_subtitles="", language_subtitles="",
-                  keep_only_one_subtitle=False):
+                  keep_only_one_subtitle=False, http_pool_size=4,
+                  use_cache=False, workers=1, api_rate=0,
+                  max_subtitle_kb=2048, watch_settle_sec=10, watch_poll_sec=60,
+                  jobs=0, filters_include="", filter_match_path=False,
+                  filter_min_kb=0, filter_max_kb=0, filter_dry_run=False,
+                  extract_best_only=False, download_top_k=0):
         """Initialisation des paramètres.
         
         * En tant que script, les paramètres sont ceux par défauts
@@ -544,9 +2404,18 @@ class Program:
                                 On rajoute ceux nécessaires.
 
         """
+        self.db_file     = 'betasub.db'
+        self.token_file  = 'betasub.token'
+
         # define default options from settings
-        self.Beta                   = Beta()
-        self.Sub                    = Sub()
+        self.Beta                   = Beta(pool_size=http_pool_size,
+                                           token_file=self.token_file)
+        self.Beta.pool.limiter.rate = float(api_rate)
+        self.Sub                    = Sub(self.Beta.pool,
+                                          max_member_size=int(max_subtitle_kb)*1024)
+        self.Outbox                 = Outbox(self.db_file)
+        self.Library                = Library(self.db_file)
+        self.outbox_thread          = None
         self.mode                   = mode
         self.login                  = login
         self.password               = password
@@ -571,10 +2440,24 @@ class Program:
         self.language_subtitles     = language_subtitles
         self.no_download_if_present = no_download_if_present
         self.keep_only_one_subtitle = keep_only_one_subtitle
+        self.use_cache              = use_cache
+        self.workers                = workers
+        self.watch_settle_sec       = watch_settle_sec
+        self.watch_poll_sec         = watch_poll_sec
+        self.jobs                   = jobs
+        self.filters_include        = filters_include
+        self.filter_match_path      = filter_match_path
+        self.filter_min_kb          = filter_min_kb
+        self.filter_max_kb          = filter_max_kb
+        self.filter_dry_run         = filter_dry_run
+        self.extract_best_only      = extract_best_only
+        self.download_top_k         = download_top_k
 
-        self.db_file     = 'betasub.db'
         self.modes       = [ 'episodes','prompt','search','file',
-                                'utorrent', 'unzip', 'filter', 'stat']
+                                'utorrent', 'unzip', 'filter', 'stat', 'feed',
+                                'watch']
+        #plus haut identifiant de sous-titre déjà vu en mode feed
+        self.feed_mark   = 0
 
         
         #initialise si ligne de commande
@@ -600,6 +2483,17 @@ class Program:
         #désactivation des filtres si pas de caractères
         if self.filters_regex == "":
             self.use_filters = False
+
+        #filtres compilés une fois: nettoyage (mode filter) et extraction
+        self.file_filter = FileFilter(exclude=self.filters_regex,
+                                      include=self.filters_include,
+                                      extensions=re.split('\|', self.extensions_filter_mode),
+                                      match_path=self.filter_match_path,
+                                      min_size=int(self.filter_min_kb)*1024,
+                                      max_size=int(self.filter_max_kb)*1024)
+        self.extract_filter = None
+        if self.use_filters == True or self.use_filters == "True":
+            self.extract_filter = self.file_filter
             
         #définition du choix de qualité du sous-titre de l'utilisateur
         if self.quality_subtitles:
@@ -612,6 +2506,11 @@ class Program:
             self.language_subtitles = self.language_subtitles.upper()
         else:
             self.language_subtitles = "VOVF"
+
+        #cache des réponses de l'api dans la base de donnée
+        if self.use_cache == True or self.use_cache == "True":
+            self.Beta.cache = ResponseCache(self.db_file)
+            self.Beta.pool.validators = ValidatorStore(self.db_file)
             
 
         #si mode défini
@@ -626,7 +2525,7 @@ class Program:
                 #si l'utilisateur veut ses srt dans un dossier special
                 if self.subtitles_dir == "" or self.subtitles_dir[0] == "|":
                     # ce n'est qu'en mode file ou utorrent
-                    if self.mode in ["file", "utorrent"]:
+                    if self.mode in ["file", "utorrent", "feed", "watch"]:
                         self.subtitles_dir = self.subtitles_dir
                     #alors le dossiers sous-titre est celui par défaut
                     else:
@@ -742,6 +2641,45 @@ class Program:
 
                 if options.keep_only_one_subtitle:
                     self.keep_only_one_subtitle = options.keep_only_one_subtitle
+
+                if options.api_rate:
+                    self.Beta.pool.limiter.rate = float(options.api_rate)
+
+                if options.workers:
+                    self.workers = int(options.workers)
+
+                if options.use_cache:
+                    self.use_cache = options.use_cache
+
+                if options.http_pool_size:
+                    self.Beta.pool.pool_size = int(options.http_pool_size)
+
+                if options.max_subtitle_kb:
+                    self.Sub.max_member_size = int(options.max_subtitle_kb)*1024
+
+                if options.watch_settle_sec:
+                    self.watch_settle_sec = options.watch_settle_sec
+
+                if options.watch_poll_sec:
+                    self.watch_poll_sec = options.watch_poll_sec
+
+                if options.jobs:
+                    self.jobs = options.jobs
+
+                if options.filters_include:
+                    self.filters_include = options.filters_include
+
+                if options.filter_match_path:
+                    self.filter_match_path = options.filter_match_path
+
+                if options.filter_dry_run:
+                    self.filter_dry_run = options.filter_dry_run
+
+                if options.extract_best_only:
+                    self.extract_best_only = options.extract_best_only
+
+                if options.download_top_k:
+                    self.download_top_k = options.download_top_k
                     
                 #exception pour le mode search
                 if self.mode == "search":
@@ -767,17 +2705,43 @@ class Program:
         """Run program
         
         """
-        #si timer avec mode episodes ou file
+        #envoie les actions membre restées en attente, sauf dans les modes
+        #locaux: mode_unzip lance des processus (fork), aucun thread ne
+        #doit alors tenir les verrous de sqlite ou de logging
+        if self.mode not in ['unzip', 'filter']:
+            self.flush_outbox()
+
+        #si timer avec mode episodes, file ou feed
         if ((self.use_updater == True or self.use_updater == "True") and
-            self.mode in ["episodes", "file"] ):
+            self.mode in ["episodes", "file", "feed"] ):
             logging.info("%s %s\n" % (self.info("using_updater"), self.delay_sec))
             self.updater(self.delay_sec,self.mode_operation)
         else:
             self.mode_operation()
+            self.wait_outbox()
             time.sleep(self.info("sleep"))
             sys.exit(self.info('exit'))
 
 
+    def flush_outbox(self):
+        """Lance en arrière-plan l'envoi des actions membre en attente.
+
+        """
+        if self.login and self.Outbox.count(self.login):
+            self.outbox_thread = self.Outbox.start(self.Beta, self.login,
+                                                   self.password)
+
+
+    def wait_outbox(self):
+        """Laisse un peu de temps à l'envoi en cours avant de quitter.
+
+        Ce qui n'est pas envoyé reste dans la base pour le prochain lancement.
+
+        """
+        if self.outbox_thread:
+            self.outbox_thread.join(self.info("sleep"))
+
+
     def mode_operation(self):
         """Mode opératoire
 
@@ -797,6 +2761,12 @@ class Program:
 
         if self.mode == 'file':
             self.mode_file()
+
+        if self.mode == 'feed':
+            self.mode_feed()
+
+        if self.mode == 'watch':
+            self.mode_watch()
             
         if self.mode == 'episodes':
             subs_list = self.mode_episodes()
@@ -813,6 +2783,126 @@ class Program:
 
 
 
+    def download_candidates(self, subs_list, title, movie_path, subtitles_dir,
+                            database=None):
+        """Télécharge et extrait les sous-titres de subs_list.
+
+        Avec download_top_k, les meilleurs candidats passent d'abord, par
+        lots de k; le lot suivant n'est téléchargé que si les précédents
+        n'ont donné aucun sous-titre retenu par choose_subtitle (archive
+        vide, filtrée, sans srt ou d'un autre épisode).
+        database: Database où enregistrer les sous-titres téléchargés.
+        Retourne (dictionnaire pour best_subtitle, True si aucun échec,
+        True si un sous-titre a été obtenu).
+
+        """
+        unzip = self.unzip == True or self.unzip == "True"
+        #crée un dictionnaire pour la fonction best_subtitle
+        subs_dict_to_compar = {}
+        complete = True
+        found = False
+        for batch in self.candidate_batches(subs_list, title, movie_path):
+            downloaded = False
+            #download en parallèle, écriture dans l'ordre de la liste
+            for subs, buffer in self.fetch_subtitles(batch):
+                #échec réseau: pas enregistré, sera retenté
+                if buffer is None:
+                    complete = False
+                    continue
+                #unzip depuis la mémoire
+                files_list = self.Sub.store_subtitle(
+                                  buffer,
+                                  subs[title],
+                                  subtitles_dir,
+                                  unzip,
+                                  self.extract_filter)
+                #save in database
+                if database is not None:
+                    database.set_data(subs['title'], subs['url'])
+
+                subs_dict_to_compar[subs['url']] = {}
+                subs_dict_to_compar[subs['url']]["file_info"] = subs
+                subs_dict_to_compar[subs['url']]["file_subs_list"] = files_list
+                downloaded = True
+            #un zip gardé tel quel (sans unzip) compte comme un résultat
+            if not unzip or not movie_path:
+                found = found or downloaded
+            else:
+                found = self.choose_subtitle(self.subtitle_candidates(subs_dict_to_compar),
+                                             self.file_base(movie_path)['name']) is not None
+            if found:
+                break
+        return subs_dict_to_compar, complete, found
+
+
+
+    def candidate_batches(self, subs_list, title, movie_path):
+        """Générateur des lots de candidats à télécharger.
+
+        Sans download_top_k (0) ou sans vidéo, un seul lot: subs_list.
+
+        """
+        top_k = int(self.download_top_k or 0)
+        if top_k <= 0 or not movie_path or len(subs_list) <= top_k:
+            yield subs_list
+            return
+        ranked = self.rank_candidates(subs_list, title, movie_path)
+        for start in range(0, len(ranked), top_k):
+            yield ranked[start:start + top_k]
+
+
+
+    def rank_candidates(self, subs_list, title, movie_path):
+        """Classe les sous-titres de l'api avant téléchargement.
+
+        Langue préférée d'abord, puis qualité, puis ressemblance entre le
+        nom du fichier de l'api et celui de la vidéo (SubtitleRanker).
+
+        """
+        ranker = SubtitleRanker(self.file_base(movie_path)['name'])
+        wanted = {'FR': ['VF', 'VOVF'], 'VF': ['VF', 'VOVF'],
+                  'EN': ['VO', 'VOVF'], 'VO': ['VO', 'VOVF']}.get(
+                                            self.language_priority.upper(), [])
+        def key(subs):
+            name = os.path.splitext(subs[title])[0]
+            return (subs['language'].upper() in wanted, subs['quality'], ranker.ratio(name))
+        #tri stable: à égalité, l'ordre de l'api est gardé
+        return sorted(subs_list, key=key, reverse=True)
+
+
+
+    def best_only(self, movie_path):
+        """True si seul le meilleur sous-titre doit être extrait
+        (extract_best_only, avec unzip et rename_subtitles, pour une vidéo).
+
+        """
+        return (self.extract_best_only in [True, 'True'] and movie_path and
+                self.mode in ['file', 'utorrent', 'feed', 'watch'] and
+                self.unzip in [True, 'True'] and self.rename_subtitles in [True, 'True'])
+
+
+
+    def fetch_subtitles(self, subs_list):
+        """Générateur de (subs, tampon) dans l'ordre de subs_list.
+
+        Les téléchargements tournent en parallèle (WorkerPool borné par
+        workers) pendant que l'appelant écrit les précédents: l'extraction
+        et la base de donnée restent dans le thread principal, dans l'ordre.
+        Un téléchargement en échec donne un tampon None.
+
+        """
+        def fetch(subs):
+            try:
+                return self.Sub.fetch_file(subs['url'])
+            except (urllib2.URLError, httplib.HTTPException, socket.error), error:
+                logging.error("download failed for %s (%s)" % (subs['url'], error))
+                return None
+
+        workers = WorkerPool(min(self.workers, len(subs_list) or 1))
+        return itertools.izip(subs_list, workers.imap(fetch, subs_list))
+
+
+
     def subtitles_preferences(self, subs_list):
         """Filtre les sous-titres disponibles en fonction du choix de l'utilisateur
 
@@ -838,12 +2928,23 @@ class Program:
         
 
 
-    def get_subtitles(self, subs_list):
+    def get_subtitles(self, subs_list, movie_path=None, default_dir=None,
+                      subtitles_dir=None):
         """Télécharge et extrait les sous-titres selon le mode
+
+        movie_path, default_dir et subtitles_dir sont ceux de la vidéo traitée,
+        par défaut ceux du programme.
         
         """
+        if movie_path is None:
+            movie_path = self.movie_path
+        if default_dir is None:
+            default_dir = self.default_dir
+        if subtitles_dir is None:
+            subtitles_dir = self.subtitles_dir
+
         #filtrage des sous-titres en fonction du mode
-        if self.mode in ["file", "utorrent", "episodes"]:
+        if self.mode in ["file", "utorrent", "episodes", "feed", "watch"]:
             subs_list = self.subtitles_preferences(subs_list)
             
         #exception car duplication intitulé filename dans l'api
@@ -855,64 +2956,50 @@ class Program:
         if subs_list != []:
             # si on utilise une base de donnée et les bons modes
             if ((self.use_database == True  or self.use_database == "True") and
-                (self.mode in ["episodes", "file", "utorrent"])):
+                (self.mode in ["episodes", "file", "utorrent", "feed", "watch"])):
                 #récupération de la base de donnée
-                database = Database(self.db_file).get_urls()
+                database = Database(self.db_file, beta=self.Beta)
+                known_urls = set(database.get_urls())
                 #sous-titres qui ne sont pas dans la base de donnée
-                new_subs = list(set([item['url'] for item in subs_list]) - set(database))
+                new_subs = list(set([item['url'] for item in subs_list]) - known_urls)
                 #si tous les sous-titres sont dans la base donnée
                 if new_subs == []:
-                    if self.mode in ["file", "utorrent"]:
-                        movie = self.file_base(self.movie_path)["name"]
+                    if self.mode in ["file", "utorrent", "feed", "watch"]:
+                        movie = self.file_base(movie_path)["name"]
                         logging.info("%s %s" % (self.info('sub_downloaded_for'), movie))
+                        #déjà téléchargés, mais le sous-titre n'a peut-être
+                        #jamais été placé (aucun gagnant): la vidéo reste à faire
+                        if self.rename_subtitles in [True, 'True']:
+                            return self.subtitle_placed(movie_path, subtitles_dir)
                     else:
                         logging.info("%s %s" % (self.info('sub_downloaded'), movie))
+                    return True
                 #si il y a de nouveaux sous-titres
                 else:
 
                     logging.info('\n%s %s in %s ...\n' % ( len(new_subs),
                                                    self.info('sub_download'),
-                                                   self.default_dir))
+                                                   default_dir))
                     #crée un dictionnaire pour la fonction best_subtitle
                     subs_dict_to_compar = {}
-                    for subs in subs_list:
-                        if subs['url'] not in database:
-                            subs_dict_to_compar[subs['url']] = {}
-                            subs_dict_to_compar[subs['url']]["file_subs_list"] = list()
-
-                            #download
-                            self.Sub.download_file(  subs[title],
-                                                      subs['url'],
-                                                      self.subtitles_dir)
-                            #save in database
-                            Database(self.db_file).set_data(subs['title'], subs['url'])
-
-                            subtitle_path = os.path.join(self.subtitles_dir,subs[title])
-                            #on crée une liste des srt(non zip) si jamais unzip = False
-                            if not zipfile.is_zipfile(subtitle_path):
-                                subs_dict_to_compar[subs['url']]["file_info"] = subs
-                                subs_dict_to_compar[subs['url']]["file_subs_list"].append(subtitle_path)
-
-
-                            #unzip
-                            if self.unzip == True or self.unzip == "True":
-                                #on prend la liste retournée par la fonction unzip
-                                zip_files_list = self.Sub.unzip_file(
-                                                  subtitle_path,
-                                                  self.subtitles_dir,
-                                                  self.use_filters,
-                                                  self.filters_regex)
-
-                                subs_dict_to_compar[subs['url']]["file_info"] = subs
-                                subs_dict_to_compar[subs['url']]["file_subs_list"] = zip_files_list
-
+                    candidates = [subs for subs in subs_list
+                                  if subs['url'] not in known_urls]
+                    #seul le meilleur sous-titre est extrait
+                    if self.best_only(movie_path):
+                        return self.extract_best_subtitle(candidates, title, movie_path,
+                                                          subtitles_dir, database=database)
+                    #download + unzip, enregistrés dans la base
+                    subs_dict_to_compar, complete, placed = self.download_candidates(
+                                          candidates, title, movie_path,
+                                          subtitles_dir, database=database)
 
                     #seulement en mode file&utorrent, on crée the best of the best, qui convient au mieux
-                    if self.mode in ['file', 'utorrent'] and self.rename_subtitles in [True, 'True']:
-                        self.best_subtitle(subs_dict_to_compar, self.movie_path)
+                    if self.mode in ['file', 'utorrent', 'feed', 'watch'] and self.rename_subtitles in [True, 'True']:
+                        placed = self.best_subtitle(subs_dict_to_compar, movie_path)
                         
-                    #retour final de validition
-                    return True
+                    #retour final de validition (False si un download a échoué
+                    #ou si aucun sous-titre n'a été placé)
+                    return complete and placed
                             
                             
             #Si on utilise pas de base de donnée
@@ -920,42 +3007,36 @@ class Program:
                 logging.info('\n%s %s' % ( len(subs_list),
                                          self.info('sub_download')))
                                          
-                #crée un dictionnaire pour la fonction best_subtitle
-                subs_dict_to_compar = {}
-                all_file_list = []
-                for subs in subs_list:
-                    subs_dict_to_compar[subs['url']] = {}
-                    subs_dict_to_compar[subs['url']]["file_subs_list"] = list()
-                    #download
-                    self.Sub.download_file(  subs[title],
-                                              subs['url'],
-                                              self.subtitles_dir)
-
-                    subtitle_path = os.path.join(self.subtitles_dir,subs[title])
-                    #on crée une liste des srt(non zip) si jamais unzip = False
-                    if not zipfile.is_zipfile(subtitle_path):
-                        subs_dict_to_compar[subs['url']]["file_info"] = subs
-                        subs_dict_to_compar[subs['url']]["file_subs_list"].append(subtitle_path)
-
-                    #unzip
-                    if self.unzip == True or self.unzip == "True":
-                        #on prend la liste retournée par la fonction unzip
-                        zip_files_list = self.Sub.unzip_file(
-                                              subtitle_path,
-                                              self.subtitles_dir,
-                                              self.use_filters,
-                                              self.filters_regex)
-
-                        subs_dict_to_compar[subs['url']]["file_info"] = subs
-                        subs_dict_to_compar[subs['url']]["file_subs_list"] = zip_files_list
+                #seul le meilleur sous-titre est extrait
+                if self.best_only(movie_path):
+                    return self.extract_best_subtitle(subs_list, title, movie_path,
+                                                      subtitles_dir)
+                #download + unzip
+                subs_dict_to_compar, complete, placed = self.download_candidates(
+                                      subs_list, title, movie_path, subtitles_dir)
                 
                 #seulement en mode file, on crée le srt qui convient au mieux
-                if self.mode in ['file', 'utorrent'] and self.rename_subtitles in [True, 'True']:
-                    self.best_subtitle(subs_dict_to_compar, self.movie_path)
+                if self.mode in ['file', 'utorrent', 'feed', 'watch'] and self.rename_subtitles in [True, 'True']:
+                    placed = self.best_subtitle(subs_dict_to_compar, movie_path)
+                return complete and placed
 
         # si il n'y a pas de sous-titres
         else:
             logging.info(self.info('no_sub'))
+        return False
+
+
+
+    def subtitle_placed(self, movie_path, subtitles_dir):
+        """True si subtitles_dir contient le sous-titre renommé de la vidéo.
+
+        """
+        name = self.file_base(movie_path)['name']
+        for ext in SubtitleRanker.extensions:
+            for variant in [ext, ext.upper()]:
+                if os.path.exists(os.path.join(subtitles_dir, "%s.%s" % (name, variant))):
+                    return True
+        return False
 
 
 
@@ -971,105 +3052,177 @@ class Program:
                              sub_url2:{...},
                              ...
                           }
+        Retourne True si le sous-titre est placé sous le nom de la vidéo.
         
         """
         d = subs_list_to_compar
         #seulement si il y a des sous-titres
         if d:
             try:
-                score = 0
-                winner = ""
-                quality = 0
-                junk_subtitles = []
-                for key in d:
-                    file_list = d[key]['file_subs_list']
-                    #pour chaque srt
-                    for item in file_list:
-                        sub_language = d[key]['file_info']['language']
-                        sub_quality = d[key]['file_info']['quality']
-                        sub_dict = self.file_base(item) #dict with basename, ext,...
-                        movie_dict = self.file_base(movie) #dict with basename, ext,...
-                        junk_subtitles.append(sub_dict['path'])
-                        #si l'utilisateur préfère du français
-                        if self.language_priority.upper() in ["FR", "VF"]:
-                            #alors si les sous-titres sont bien en français
-                            if sub_language.upper() in ['VF','VOVF']:
-                                #et si parmi ceux présents ils sont bien fr
-                                if re.match(".*(\.FR|\.VF)", sub_dict['name'], re.IGNORECASE):
-                                    #on compare le titre du srt avec celui du film
-                                    compar = difflib.SequenceMatcher(None, movie_dict['name'], sub_dict['name'])
-                                    #cela donne un ratio de ressemblance
-                                    ratio = compar.ratio()
-                                    #on ne va garder que celui dont le ratio est le plus élevé...
-                                    if ratio >= score:
-                                        #avec la qualité la plus élevée
-                                        if sub_quality >= quality:
-                                            score = ratio
-                                            quality = sub_quality
-                                            winner = sub_dict['path']
-
-
-                        #si l'utilisateur préfère de l'anglais
-                        if self.language_priority.upper() in ["EN", "VO"]:
-                            #alors si les sous-titres sont bien en anglais
-                            if sub_language.upper() in ['VO','VOVF']:
-                                #et si parmi ceux présents ils sont bien anglais
-                                if not re.match( ".*(\.FR|\.VF)",
-                                                 sub_dict['name'],
-                                                 re.IGNORECASE):
-                                    #on compare le titre du srt avec celui du film
-                                    compar = difflib.SequenceMatcher( None,
-                                                                     movie_dict['name'],
-                                                                     sub_dict['name'])
-                                    #cela donne un ratio de ressemblance
-                                    ratio = compar.ratio()
-                                    #on ne va garder que celui dont le ratio est le plus élevé...
-                                    if ratio >= score:
-                                        # avec la qualité la plus élevée
-                                        if sub_quality >= quality:
-                                            score = ratio
-                                            quality = sub_quality
-                                            winner = sub_dict['path']
-
-
-                if winner == "":
-                    score = 0
-                    quality = 0
-                    for key in d:
-                        file_list = d[key]['file_subs_list']
-                        #pour chaque srt
-                        for item in file_list:
-                            sub_language = d[key]['file_info']['language']
-                            sub_quality = d[key]['file_info']['quality']
-                            sub_dict = self.file_base(item) #dict with basename, ext,...
-                            movie_dict = self.file_base(movie) #dict with basename, ext,..
-                            #on compare le titre du srt avec celui du film
-                            compar= difflib.SequenceMatcher( None,
-                                                             movie_dict['name'],
-                                                             sub_dict['name'])
-                            #cela donne un ratio de ressemblance
-                            ratio = compar.ratio()
-                            #on ne va garder que celui dont le ratio est le plus élevé...
-                            if ratio >= score:
-                                # avec la qualité la plus élevée
-                                if sub_quality >= quality:
-                                    score = ratio
-                                    quality = sub_quality
-                                    winner = sub_dict['path']
+                movie_dict = self.file_base(movie) #dict with basename, ext,...
+                candidates = self.subtitle_candidates(d)
+                junk_subtitles = [candidate[0] for candidate in candidates]
 
+                winner = self.choose_subtitle(candidates, movie_dict['name'])
+                #aucun fichier de sous-titres de cet épisode: rien à renommer
+                if winner is None:
+                    logging.info("No subtitle to rename for %s" % movie_dict['name'])
+                    return False
 
                 #au final, on a le gagnant..
                 winner = self.file_base(winner)
                 src = winner['path']
                 dst = os.path.join(winner['dir'], movie_dict['name']+ winner['ext'])
-                #Crée une copie du fichier renommée
-                self.rename_file(src, dst)
-                #supprime les autres sous-titres si l'utilisateur le souhaite
-                self.remove_junk_subtitles(junk_subtitles)
+                #déplace le gagnant si les autres sous-titres seront supprimés,
+                #sinon lien physique (copie en dernier recours)
+                keep_source = self.keep_only_one_subtitle not in [True, 'True']
+                if self.rename_file(src, dst, keep_source):
+                    #supprime les autres sous-titres si l'utilisateur le souhaite
+                    self.remove_junk_subtitles([j for j in junk_subtitles
+                                                if j not in [src, dst]])
+                    return True
             except:
                 logging.error('Failed to find the best subtitle to rename %s' % movie)
+        return False
         
 
+    def subtitle_candidates(self, subs_list_to_compar):
+        """Candidats de choose_subtitle à partir du dictionnaire de best_subtitle.
+
+        [(path, name, ext, language, quality), ...]
+
+        """
+        d = subs_list_to_compar
+        candidates = []
+        for key in d:
+            #pour chaque srt
+            for item in d[key]['file_subs_list']:
+                sub_dict = self.file_base(item) #dict with basename, ext,...
+                candidates.append((item, sub_dict['name'], sub_dict['ext'],
+                                   d[key]['file_info']['language'],
+                                   d[key]['file_info']['quality']))
+        return candidates
+
+
+
+    def choose_subtitle(self, candidates, movie_name):
+        """Choisit le sous-titre qui convient le mieux à la vidéo.
+
+        candidates = [(ref, name, ext, language, quality), ...] où ref est
+        retourné pour le gagnant (None si aucun).  La langue préférée passe
+        d'abord, puis la qualité et la ressemblance (SubtitleRanker).
+
+        """
+        ranker = SubtitleRanker(movie_name)
+        entries = []
+        for ref, name, ext, language, quality in candidates:
+            if ext.lstrip('.').lower() not in ranker.extensions:
+                continue
+            french = ranker.french.match(name) is not None
+            entries.append((ref, name, quality, language.upper(), french))
+
+        winner = None
+        priority = self.language_priority.upper()
+        #si l'utilisateur préfère du français: srt fr des sous-titres VF
+        if priority in ["FR", "VF"]:
+            winner = ranker.best((ref, name, quality)
+                                 for ref, name, quality, language, french in entries
+                                 if language in ['VF', 'VOVF'] and french)
+        #si l'utilisateur préfère de l'anglais: srt non fr des sous-titres VO
+        if priority in ["EN", "VO"]:
+            winner = ranker.best((ref, name, quality)
+                                 for ref, name, quality, language, french in entries
+                                 if language in ['VO', 'VOVF'] and not french)
+        #sinon, le plus ressemblant toutes langues confondues
+        if winner is None:
+            winner = ranker.best((ref, name, quality)
+                                 for ref, name, quality, language, french in entries)
+        return winner
+
+
+
+    def extract_best_subtitle(self, subs_list, title, movie_path, subtitles_dir,
+                              database=None):
+        """Mode extract_best_only: seul le meilleur sous-titre est écrit.
+
+        Les candidats sont classés d'après le contenu des zips (namelist,
+        file_info de l'api) sans rien extraire, puis le gagnant est écrit
+        directement sous le nom de la vidéo: une écriture par épisode.
+        database: Database où enregistrer les sous-titres téléchargés.
+        Retourne True si le sous-titre est écrit et tous les downloads ont réussi.
+
+        """
+        movie_name = self.file_base(movie_path)['name']
+        candidates = []
+        opened = []
+        complete = True
+        try:
+            #download en parallèle, rien n'est écrit; lot suivant
+            #seulement si les précédents n'ont rien donné
+            winner = None
+            for batch in self.candidate_batches(subs_list, title, movie_path):
+                for subs, buffer in self.fetch_subtitles(batch):
+                    if buffer is None:
+                        complete = False
+                        continue
+                    opened.append(buffer)
+                    logging.info(subs[title])
+                    if database is not None:
+                        database.set_data(subs['title'], subs['url'])
+                    language, quality = subs['language'], subs['quality']
+                    is_zip = buffer.read(4) in self.Sub.zip_magic
+                    buffer.seek(0)
+                    if not is_zip:
+                        name, ext = os.path.splitext(subs[title])
+                        candidates.append(((None, buffer), name, ext, language, quality))
+                        continue
+                    try:
+                        zip_data = zipfile.ZipFile(buffer, 'r')
+                    except zipfile.BadZipfile:
+                        logging.error("Bad zip file: %s" % subs[title])
+                        continue
+                    opened.append(zip_data)
+                    for info in self.Sub.zip_members(zip_data, self.extract_filter):
+                        name, ext = os.path.splitext(info.filename.split("/")[-1])
+                        candidates.append(((zip_data, info), name, ext, language, quality))
+                winner = self.choose_subtitle(candidates, movie_name)
+                if winner is not None:
+                    break
+
+            if winner is None:
+                logging.info("No Subtitles for %s" % movie_name)
+                return False
+            for ref, name, ext, language, quality in candidates:
+                if ref is winner:
+                    break
+            zip_data, item = winner
+            dst = os.path.join(subtitles_dir, movie_name + ext)
+            #écriture du gagnant sous un nom temporaire, puis rename
+            temp = self.Sub.temp_file(dst)
+            try:
+                if zip_data is not None:
+                    written = self.Sub.extract_member(zip_data, item, temp)
+                else:
+                    sub = open(temp, "wb")
+                    try:
+                        shutil.copyfileobj(item, sub)
+                    finally:
+                        sub.close()
+                    written = True
+                if written:
+                    self.Sub.replace_file(temp, dst)
+            finally:
+                if os.path.exists(temp):
+                    os.remove(temp)
+            if written:
+                logging.info("%s -> %s" % (name + ext, os.path.basename(dst)))
+            return complete and written
+        finally:
+            for item in reversed(opened):
+                item.close()
+
+
+
     def remove_junk_subtitles(self, junk_subtitles):
         """Supprime les sous-titres restant après avoir récupérer le bon
 
@@ -1084,88 +3237,143 @@ class Program:
                 pass
 
 
-    def rename_file(self, source, destination):
-        """Crée une copie du fichier
+    def rename_file(self, source, destination, keep_source=True):
+        """Place source sous le nom destination.
+
+        Sans keep_source, simple os.rename; sinon lien physique. La copie
+        n'est faite qu'entre deux systèmes de fichiers (ou sans os.link).
+        destination n'apparaît qu'une fois complète (nom temporaire + rename).
+        Retourne True si le fichier est placé.
 
         """
         try:
-            shutil.copyfile(source, destination)
+            if os.path.abspath(source) == os.path.abspath(destination):
+                return True
+            if not keep_source:
+                try:
+                    self.Sub.replace_file(source, destination)
+                    return True
+                except OSError, e:
+                    if e.errno != errno.EXDEV:
+                        raise
+            temp = self.Sub.temp_file(destination)
+            try:
+                try:
+                    #os.link refuse une destination existante
+                    os.remove(temp)
+                    os.link(source, temp)
+                except (AttributeError, OSError):
+                    shutil.copyfile(source, temp)
+                self.Sub.replace_file(temp, destination)
+            except:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+            if not keep_source:
+                os.remove(source)
+            return True
         except:
             logging.error('Problem to rename %s' % source)
-            pass
+            return False
+
 
 
-    def define_subtitles_dir(self):
+    def define_subtitles_dir(self, default_dir=None):
         """defintion du dossier de téléchargement en fonction des pref utilisateur
 
+        Retourne le dossier des sous-titres d'une vidéo de default_dir
+        (par défaut celui du programme).
+
         """
+        if default_dir is None:
+            default_dir = self.default_dir
         # on défnit maintenant le dossier de téléchargement des srt
         #si le dossier subs_dir existe,...
         if os.path.isdir(self.subtitles_dir):
             #...on doit télécharger srt dans un tout autre dossier
-            self.subtitles_dir = self.subtitles_dir
+            return self.subtitles_dir
         #si le dossier subs_dir est vide,...
         elif self.subtitles_dir == "":
             #... on doit télécharger srt dans le dossier de la vidéo
-            self.subtitles_dir = self.default_dir
+            return default_dir
         #si le dossier subs_dir est un nom,...
         elif self.subtitles_dir[0] == "|":
             #... on doit télécharger srt dans dossier special pour chaque video
-            special_sub_dir = os.path.join(self.default_dir, self.subtitles_dir[1:])
-            if os.path.isdir(special_sub_dir):
-                 self.subtitles_dir = special_sub_dir
-            else:
-                 os.makedirs(special_sub_dir)
-                 self.subtitles_dir = special_sub_dir
+            special_sub_dir = os.path.join(default_dir, self.subtitles_dir[1:])
+            if not os.path.isdir(special_sub_dir):
+                try:
+                    os.makedirs(special_sub_dir)
+                #déjà créé par une autre tâche
+                except OSError:
+                    pass
+            return special_sub_dir
 
 
 
-    def define_video_list(self):
+    def define_video_list(self, stats=None):
         """Crée la liste des vidéos dont les sous-titres devront être recupérés
 
+        stats: si donné, est rempli avec {path: (size, mtime)}
+
         """
         ext = re.split('\|', self.series_extensions)
-        #liste des vidéos présentes
-        video_list = self.Sub.files_list(  self.default_dir,
-                                          extensions=ext,
-                                          subfolders=self.use_subfolders)
-
-        #si l'utilisateur ne veut pas de sous-titres si la vidéo en a déjà
+        video_ext = set(e.lower() for e in ext)
+        #si l'utilisateur ne veut pas de sous-titres si la vidéo en a déjà,
+        #les sous-titres sont indexés pendant le même parcours
+        present = None
         if self.no_download_if_present:
-            #si dossier unique de srt
-            if os.path.isdir(self.subtitles_dir):
-                #liste des sous-titres pour comparaison
-                subtitles_list= self.Sub.files_list(self.subtitles_dir,
-                                                  extensions= ['srt'],
-                                                  subfolders= self.use_subfolders)
-                #videos restantes
-                video_list[:] = (video for video in video_list if os.path.join(self.file_base(self.subtitles_dir)["dir"], self.file_base(video)["name"]+".srt") not in subtitles_list)
-
-
-            #si srt dans dossier vidéo
-            elif self.subtitles_dir == "":
-                #liste des sous-titres pour comparaison
-                subtitles_list= self.Sub.files_list(self.default_dir,
-                                                  extensions=['srt'],
-                                                  subfolders=self.use_subfolders)
-                #videos restantes
-                video_list[:] = (video for video in video_list if video[:-4]+".srt" not in subtitles_list)
-
-
-            #si srt dans dossier spécial
-            elif self.subtitles_dir[0] == "|":
-                #liste des sous-titres pour comparaison
-                subtitles_list = self.Sub.files_list(self.default_dir,
-                                                  extensions=['srt'],
-                                                  subfolders=self.use_subfolders)
-                #videos restantes
-                video_list[:] = (video for video in video_list if os.path.join(self.file_base(video)["dir"], self.subtitles_dir[1:] ,self.file_base(video)["name"]+".srt") not in subtitles_list)
+            present = SubtitleIndex(self.Sub)
+            ext = ext + present.extensions
+        #liste des vidéos présentes (un seul stat par fichier)
+        video_list = []
+        for entry in self.Sub.scan(  self.default_dir,
+                                     extensions=ext,
+                                     subfolders=self.use_subfolders):
+            if os.path.splitext(entry['path'])[1][1:].lower() not in video_ext:
+                present.add(entry['path'])
+                continue
+            video_list.append(entry['path'])
+            if stats is not None:
+                stats[entry['path']] = (entry['size'], entry['mtime'])
+        if not video_list:
+            logging.info("No file.")
+
+        if present is not None:
+            self.remove_present(video_list, present)
 
         #retour la liste final des vidéos
         return video_list
 
 
 
+    def remove_present(self, video_list, present, scan=False):
+        """Retire de video_list les vidéos qui ont déjà des sous-titres.
+
+        present: SubtitleIndex
+        scan: lit les dossiers des vidéos au besoin (sinon déjà indexés)
+
+        """
+        name = lambda video: os.path.splitext(os.path.basename(video))[0]
+        #si dossier unique de srt
+        if os.path.isdir(self.subtitles_dir):
+            present.scan(self.subtitles_dir)
+            video_list[:] = [video for video in video_list
+                             if not present.has(self.subtitles_dir, name(video))]
+
+        #si srt dans dossier vidéo
+        elif self.subtitles_dir == "":
+            video_list[:] = [video for video in video_list
+                             if not present.has(os.path.dirname(video), name(video), scan)]
+
+        #si srt dans dossier spécial (lu au besoin, une fois par dossier)
+        elif self.subtitles_dir[0] == "|":
+            special = self.subtitles_dir[1:]
+            video_list[:] = [video for video in video_list
+                             if not present.has(os.path.join(os.path.dirname(video), special),
+                                                name(video), scan=True)]
+
+
+
 
 
 
@@ -1183,27 +3391,15 @@ class Program:
                 os._exit(1)
 
             #vérification du nom de la série en la transformant en nom url
-            show = data[0].lower()
-            show_list = self.Beta.show_url(show)
-            #si il y a plusieurs choix de séries on prend celui qui correspond le mieux
-            for item in show_list:
-                #test whether every element in showurl is in show
-                if set(item['url']) <= set(show):
-                    show=item['url']
-                    show_name = item['title']
-                else:
-                    show = show_list[0]['url']
-                    show_name = show_list[0]['title']
+            item = self.Beta.resolve_show(data[0])
+            show = item['url']
             season = data[1]
             episode = data[2]
 
-            watched = self.Beta.member_watched(  self.login, self.password,
-                                                show, season, episode)
-            if watched == 1:
-                logging.info("\n[%s season %s episode %s] is watched on Betaseries !" % (show_name,
-                                                                                        season,
-                                                                                        episode))
-            time.sleep(self.info("sleep"))
+            #l'action est gardée dans la base, puis envoyée en arrière-plan
+            self.Outbox.put('watched', self.login, show, season, episode)
+            self.flush_outbox()
+            self.wait_outbox()
             os._exit(1)
         except:
             logging.error('something\'s wrong...')
@@ -1218,7 +3414,7 @@ class Program:
 
         """
         logging.info(self.info("working"))
-        db = Database(database=self.db_file, stat=True)
+        db = Database(database=self.db_file, stat=True, beta=self.Beta)
         db.get_summary()
         logging.info("\n\n")
         raw_input(self.info("pause"))
@@ -1229,45 +3425,73 @@ class Program:
 
     def mode_unzip(self):
         """Elaboration du mode unzip
-        
+
+        Les archives sont réparties sur jobs processus (0 = un par coeur).
+
         """
         logging.info(self.info("unzip"))
-        reset_default_dir = self.default_dir
+        start = time.time()
         #va chercher tous les zip du dossier
-        for zip_file in self.Sub.files_list( self.default_dir,
+        tasks = [(entry['path'], self.extract_filter, self.Sub.max_member_size)
+                 for entry in self.Sub.scan( self.default_dir,
                                              extensions=['zip'],
-                                             subfolders=self.use_subfolders):
-                                             
-            #dossier du fichier zip
-            real_default_dir = "%s\\" % os.path.dirname(zip_file)
-            #définition du dossier des  vidéos
-            self.default_dir = real_default_dir
-            #dezippe tous les zips
-            self.Sub.unzip_file(  zip_file,
-                                  self.default_dir,
-                                  self.use_filters,
-                                  self.filters_regex)
-            logging.info(os.path.basename(zip_file))
-            #reset du dossier de téléchargement pour la suite
-            self.default_dir = reset_default_dir
+                                             subfolders=self.use_subfolders)]
+        if not tasks:
+            logging.info(self.info("no_unzip"))
+            return
+
+        jobs = int(self.jobs) or multiprocessing.cpu_count()
+        jobs = min(jobs, len(tasks))
+        pool = None
+        if jobs > 1:
+            try:
+                pool = multiprocessing.Pool(jobs)
+            except (OSError, ImportError), error:
+                logging.warning("no process pool (%s), unzip on one core" % error)
+        try:
+            if pool is not None:
+                results = pool.imap(unzip_archive, tasks, chunksize=8)
+            else:
+                results = itertools.imap(unzip_archive, tasks)
+            extracted = 0
+            errors = []
+            for zip_file, files, error in results:
+                if error:
+                    errors.append((zip_file, error))
+                    logging.error("%s: %s" % (os.path.basename(zip_file), error))
+                else:
+                    extracted += len(files)
+                    logging.info(os.path.basename(zip_file))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        elapsed = max(time.time() - start, 0.001)
+        logging.info("\n%s archives, %s files, %s errors in %.1fs (%.1f archives/sec)" % (
+                         len(tasks), extracted, len(errors), elapsed, len(tasks) / elapsed))
 
 
 
     def mode_filter(self):
         """Elaboration du mode filter
 
+        Un seul parcours du dossier; les fichiers filtrés sont effacés par
+        lots (ou seulement listés avec filter_dry_run).
+
         """
         logging.info(self.info("filter"))
-        ext = re.split('\|', self.extensions_filter_mode)
+        dry_run = self.filter_dry_run == True or self.filter_dry_run == "True"
         #va chercher tous les srt et autres du dossier
-        for _file in self.Sub.files_list(  self.default_dir,
-                                           extensions=ext,
-                                           subfolders=self.use_subfolders):
-
-            if re.search(self.filters_regex, _file) != None:
-                #efface les fichiers filtrés
-                os.remove(_file)
-                logging.info(os.path.basename(_file))
+        entries = self.Sub.scan(  self.default_dir,
+                                  extensions=self.file_filter.extensions,
+                                  subfolders=self.use_subfolders)
+        count, size, errors = self.file_filter.delete(
+                                  self.file_filter.select(entries), dry_run)
+        if dry_run:
+            logging.info("\n%s files (%s KB) would be removed" % (count, size // 1024))
+        else:
+            logging.info("\n%s files (%s KB) removed, %s errors" % (count, size // 1024, errors))
 
 
 
@@ -1313,28 +3537,16 @@ class Program:
             
         #vérification du nom de la série en la transformant en nom url
         show = data[0].lower()
-        show_list = self.Beta.show_url(show)
-        #si il y a plusieurs choix de séries on prend celui qui correspond le mieux
-        for item in show_list:
-            #test whether every element in showurl is in show
-            if set(item['url']) <= set(show):
-                show = item['url']
-            else:
-                show = show_list[0]['url']
+        item = self.Beta.resolve_show(show)
+        if item:
+            show = item['url']
         season = data[1]
         episode = data[2]
         if self.set_episode_downloaded:
-            #marque l'épisode comme téléchargé sur Betaseries
-            downloaded = self.Beta.member_downloaded( self.login,
-                                                     self.password,
-                                                     show, season, episode)
-            #affiche message en console en fonction dur retour
-            if downloaded == "1":
-                logging.info("%s S%sE%s downloaded on Betaseries!" % (
-                                                    show,season, episode))
-            if downloaded == "0":
-                logging.info("%s S%sE%s not downloaded on Betaseries!" % (
-                                                      show, season, episode))
+            #marque l'épisode comme téléchargé sur Betaseries, en arrière-plan
+            #pour ne pas retarder la récupération des sous-titres
+            self.Outbox.put('downloaded', self.login, show, season, episode)
+            self.flush_outbox()
 
         #le mode utorrent étant similaire, on utilise le mode search.
         subs_list = self.Beta.search_subtitles(show, season, episode)
@@ -1342,7 +3554,7 @@ class Program:
         self.movie_path = os.path.join(self.default_dir, self.search)
 
         #on défini le dossier de téléchargement des sous-titres
-        self.define_subtitles_dir()
+        self.subtitles_dir = self.define_subtitles_dir()
         
         return subs_list
         
@@ -1354,43 +3566,287 @@ class Program:
         """Elaboration du mode file
         
         """
-        #variable de remise à zero du dossier de téléchargement
-        reset_default_dir = self.default_dir
-        resest_subtitles_dir = self.subtitles_dir
-        video_list = self.define_video_list()
+        stats = {}
+        video_list = self.define_video_list(stats)
             
         #si il n'y a aucune video
         if not video_list:
             logging.info("You've no need BetaSub right now !")
             time.sleep(self.info("sleep"))
             sys.exit()
-            
-        for files in video_list:
-            #dossier du fichier vidéo
-            real_default_dir = "%s\\" % os.path.dirname(files)
-            #liste des srt du fichier
-            subs_list = self.Beta.file_subtitles(files)
-            if subs_list == []:
-                file_name = self.file_base(files)['name']
-                logging.info("No Subtitles for %s" % file_name)
-                pass
-            else:
-                #définition du dossier des  vidéos
-                self.default_dir = real_default_dir
-                #on défini le dossier de téléchargement des sous-titres
-                self.define_subtitles_dir()
-                #définition du nom du fichier
-                self.movie_path = files
-                #téléchargement
-                self.get_subtitles(subs_list)
 
-                #reset du dossier de téléchargement pour la suite
-                self.default_dir = reset_default_dir
-                self.subtitles_dir = resest_subtitles_dir
+        self.process_videos(video_list, stats, self.default_dir)
+        self.report_stats()
+
+
+
+    def report_stats(self):
+        """Affiche les compteurs du cache de l'api et du pool http.
+
+        """
+        if self.Beta.cache:
+            logging.info("cache: %(hits)s hits, %(misses)s misses" % self.Beta.cache.stats())
+        logging.info("http: %(requests)s requests, %(opened)s connections, "
+                     "%(retried)s retries, %(backoff).1fs backoff, "
+                     "%(waited).1fs rate limit" % self.Beta.pool.stats())
+        logging.info("http: %(bytes_wire)s bytes on wire for %(bytes_data)s bytes "
+                     "of data, %(not_modified)s not modified" % self.Beta.pool.stats())
+
+
+
+    def process_videos(self, video_list, stats, directory=None):
+        """Recherche et télécharge les sous-titres d'une liste de vidéos.
+
+        stats: {path: (size, mtime)} pour l'index de la bibliothèque
+        directory: dossier entièrement parcouru (nettoyage de l'index)
+
+        """
+        #avec la base, seules les vidéos nouvelles, modifiées ou sans
+        #sous-titres sont traitées
+        use_library = self.use_database == True or self.use_database == "True"
+        if use_library:
+            pending = set(self.Library.pending(stats, directory))
+            video_list = [video for video in video_list if video in pending]
+            if not video_list:
+                logging.info("No new video.")
+                return
+
+        workers = WorkerPool(self.workers)
+        self.Beta.resolver.reset()
+        self.resolve_library(video_list, workers)
+
+        #les listes de srt sont récupérées en parallèle, mais traitées dans
+        #l'ordre des vidéos
+        subs_lists = workers.imap(self.Beta.file_subtitles, video_list)
+        results = [self.file_task(files, subs_list)
+                   for files, subs_list in zip(video_list, subs_lists)]
+
+        if use_library:
+            self.index_library(video_list, stats, results)
+
+
+
+    def mode_watch(self):
+        """Elaboration du mode watch
+
+        La bibliothèque est traitée une fois, puis chaque nouvelle vidéo est
+        traitée dès qu'elle est complète (inotify, ou scrutation sinon).
+        Un lot en échec (réseau coupé...) est reproposé après poll secondes,
+        sans arrêter la surveillance.
+
+        """
+        stats = {}
+        failed = []
+        video_list = self.define_video_list(stats)
+        if video_list:
+            try:
+                self.process_videos(video_list, stats, self.default_dir)
+            except Exception, error:
+                logging.error("Watch: library pass failed (%s)" % error)
+                failed = video_list
+
+        watcher = Watcher(self.default_dir,
+                          re.split('\\|', self.series_extensions),
+                          self.use_subfolders,
+                          settle=self.watch_settle_sec,
+                          poll=self.watch_poll_sec,
+                          scanner=self.Sub)
+        queue = watcher.start()
+        logging.info("%s %s\n" % (self.info("watching"), self.default_dir))
+        if failed:
+            self.requeue_videos(queue, failed, watcher.poll)
+        while True:
+            #timeout: garde le programme interruptible (ctrl+c)
+            try:
+                videos = [queue.get(timeout=1)]
+            except Queue.Empty:
+                continue
+            #les vidéos arrivées en même temps sont traitées ensemble
+            while True:
+                try:
+                    videos.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stats = {}
+            for video in videos:
+                try:
+                    info = os.stat(video)
+                except OSError:
+                    continue
+                stats[video] = (info.st_size, info.st_mtime)
+            video_list = [video for video in videos if video in stats]
+            #même règle que le premier passage: index relu à chaque lot
+            if self.no_download_if_present:
+                self.remove_present(video_list, SubtitleIndex(self.Sub), scan=True)
+            if video_list:
+                try:
+                    self.process_videos(video_list, stats)
+                    self.flush_outbox()
+                except Exception, error:
+                    logging.error("Watch: %s video(s) failed (%s)" % (len(video_list), error))
+                    self.requeue_videos(queue, video_list, watcher.poll)
+
+
+
+    def requeue_videos(self, queue, video_list, delay):
+        """Remet video_list dans la file de mode_watch après delay secondes.
 
+        """
+        def requeue():
+            for video in video_list:
+                queue.put(video)
+        timer = Timer(delay, requeue)
+        timer.daemon = True
+        timer.start()
 
 
         
+    def index_library(self, video_list, stats, results):
+        """Met à jour l'index avec le résultat de chaque vidéo traitée.
+
+        """
+        data = self.Beta.extract_data_many([os.path.split(v)[-1] for v in video_list])
+        names = dict((num, (show, season, episode)) for num, show, season, episode
+                     in zip(data['index'], data['shows'], data['seasons'], data['episodes']))
+        entries = []
+        for num, video in enumerate(video_list):
+            show, season, episode = names.get(num, ("", "", ""))
+            if num not in names:
+                status = 'unparsed'
+            elif results[num]:
+                status = 'done'
+            else:
+                status = 'pending'
+            entries.append((video,) + stats[video] + (show, season, episode, status))
+        self.Library.update(entries)
+
+
+
+    def resolve_library(self, video_list, workers):
+        """Résout les séries des vidéos, une seule fois par série.
+
+        Le coût dépend du nombre de séries, pas du nombre d'épisodes.
+
+        """
+        shows = self.Beta.resolver.group(video_list)
+        list(workers.imap(self.Beta.resolve_show, shows.keys()))
+
+
+
+    def feed_wanted(self, video_list):
+        """Index des épisodes recherchés dans la bibliothèque.
+
+        {(show_title, season, episode, language): video_path}
+        show_title: titre Betaseries normalisé, comme le champ title du flux.
+
+        """
+        languages = {'VF': ['VF', 'VOVF'],
+                     'VO': ['VO', 'VOVF']}.get(self.language_subtitles,
+                                               ['VO', 'VF', 'VOVF'])
+        wanted = {}
+        data = self.Beta.extract_data_many([os.path.split(v)[-1] for v in video_list])
+        for num, show, season, episode in zip(data['index'], data['shows'],
+                                              data['seasons'], data['episodes']):
+            try:
+                season, episode = int(season), int(episode)
+            except ValueError:
+                continue
+            item = self.Beta.resolve_show(show)
+            if not item:
+                continue
+            for language in languages:
+                title = self.Beta.resolver.normalize(item['title'])
+                wanted[(title, season, episode, language)] = video_list[num]
+        return wanted
+
+
+
+    def feed_key(self, sub):
+        """Clé d'un sous-titre du flux, comparable à celles de feed_wanted.
+
+        """
+        try:
+            return (self.Beta.resolver.normalize(sub['title']), int(sub['season']),
+                    int(sub['episode']), sub['language'].upper())
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None
+
+
+
+    def subtitle_id(self, sub):
+        """Identifiant numérique d'un sous-titre, tiré de son url (.../srt/310234).
+
+        """
+        match = re.search(r'(\d+)/?$', sub.get('url', ''))
+        if match:
+            return int(match.group(1))
+        return 0
+
+
+
+    def mode_feed(self):
+        """Elaboration du mode feed
+
+        Une seule requête par cycle: les derniers sous-titres de Betaseries
+        sont comparés aux épisodes de la bibliothèque, seuls ceux qui
+        correspondent sont téléchargés.
+        Le repère (feed_mark) n'est gardé qu'en mémoire, le temps de
+        l'instance: chaque lancement relit tout le flux, les sous-titres
+        déjà téléchargés étant écartés par la base (use_database).
+
+        """
+        video_list = self.define_video_list()
+        if not video_list:
+            logging.info("You've no need BetaSub right now !")
+            return
+
+        self.resolve_library(video_list, WorkerPool(self.workers))
+        wanted = self.feed_wanted(video_list)
+
+        #on ne garde que les sous-titres pas encore vus
+        feed = self.Beta.last_subtitles(number=100) or []
+        mark = self.feed_mark
+        matches = {}
+        for sub in feed:
+            sub_id = self.subtitle_id(sub)
+            if sub_id and sub_id <= self.feed_mark:
+                continue
+            mark = max(mark, sub_id)
+            video = wanted.get(self.feed_key(sub))
+            if video:
+                matches.setdefault(video, []).append(sub)
+        self.feed_mark = mark
+
+        if not matches:
+            logging.info(self.info('no_sub'))
+        for video in video_list:
+            if video in matches:
+                self.file_task(video, matches[video])
+        self.report_stats()
+
+
+
+    def file_task(self, files, subs_list):
+        """Télécharge les sous-titres d'une vidéo du mode file.
+
+        Les dossiers sont propres à la vidéo, l'état du programme n'est pas
+        modifié.  Retourne True si la vidéo a ses sous-titres.
+
+        """
+        if subs_list == []:
+            file_name = self.file_base(files)['name']
+            logging.info("No Subtitles for %s" % file_name)
+        else:
+            #dossier du fichier vidéo
+            default_dir = os.path.join(os.path.dirname(files), "")
+            #dossier de téléchargement des sous-titres
+            subtitles_dir = self.define_subtitles_dir(default_dir)
+            #téléchargement
+            return self.get_subtitles(subs_list, files, default_dir, subtitles_dir)
+        return False
+
+
+
     def mode_prompt(self):
         """Elaboration du mode prompt
 
@@ -1417,7 +3873,7 @@ class Program:
             logging.info(self.info('warning_mode_search'))
             self.search = raw_input('search: ')
         #astuce pour switcher de mode.
-        if self.search in ['episodes', 'prompt', 'file', 'stat', 'unzip', 'filter']:
+        if self.search in ['episodes', 'prompt', 'file', 'feed', 'watch', 'stat', 'unzip', 'filter']:
             self.mode = self.search
             self.mode_operation()
         else:
@@ -1516,7 +3972,7 @@ class Program:
         usage = 'use: %prog --mode=file --directory="c:\\download\\subs\\" --unzip=True'
         parser = OptionParser(usage=usage)
         parser.add_option("-m","--mode", dest="mode",
-                          help="mode to use: episodes/search/prompt/file/unzip/filter/stat")
+                          help="mode to use: episodes/search/prompt/file/feed/unzip/filter/stat")
                           
         parser.add_option("-l","--login", dest="login",
                           help="login")
@@ -1580,6 +4036,45 @@ class Program:
                                   
         parser.add_option("--onlyone", dest="keep_only_one_subtitle",
                           help="Keep only one subtitle for the video")
+
+        parser.add_option("--rate", dest="api_rate",
+                          help="Maximum Betaseries requests per second (0 = no limit)")
+
+        parser.add_option("--workers", dest="workers",
+                          help="Number of videos looked up at the same time in file mode")
+
+        parser.add_option("--cache", dest="use_cache",
+                          help="Cache Betaseries responses in the database")
+
+        parser.add_option("--poolsize", dest="http_pool_size",
+                          help="Number of keep-alive connections kept per host")
+
+        parser.add_option("--maxsize", dest="max_subtitle_kb",
+                          help="Skip zipped files bigger than this size in KB (0 = no limit)")
+
+        parser.add_option("--settle", dest="watch_settle_sec",
+                          help="Watch mode: seconds a new video must stay unchanged")
+
+        parser.add_option("--poll", dest="watch_poll_sec",
+                          help="Watch mode: scan frequency in sec. when inotify is unavailable")
+
+        parser.add_option("--jobs", dest="jobs",
+                          help="Unzip mode: number of processes (0 = one per core)")
+
+        parser.add_option("--include", dest="filters_include",
+                          help="Keep only files matching this regex (filter and unzip)")
+
+        parser.add_option("--matchpath", dest="filter_match_path",
+                          help="Filters match the full path instead of the file name")
+
+        parser.add_option("--dryrun", dest="filter_dry_run",
+                          help="Filter mode: only list the files that would be removed")
+
+        parser.add_option("--bestonly", dest="extract_best_only",
+                          help="Extract only the best subtitle, under the video name")
+
+        parser.add_option("--topk", dest="download_top_k",
+                          help="Download only the k best subtitles of a video (0 = all)")
                           
         #si l'aide est demandée, on l'affiche et ferme le programme
         if sys.argv[1] in ["-h", "--help"]:
@@ -1667,8 +4162,8 @@ class Program:
         pause                 = "Press ENTER to exit",
         sleep                 = 3,
         warning_mode_search   = "Holy crap!\nThe search must:\n    1) use a pattern like: dexter s01e01  or  the office 3\n    2) be more than 2 chararcter\n\n",
-        warning_mode          = "You must provide mode parameter --mode=episodes/file/search/prompt/utorrent/unzip/filter",
-        warning_cmdl          = 'Frak!\nIt seems you use command line.\n\nYou must at least provide MODE argument to start:\n\n--mode=episodes/search/file/prompt/unzip/filter/stat\n\n\nexample:   BetaSub.py --mode=episodes   ',
+        warning_mode          = "You must provide mode parameter --mode=episodes/file/feed/watch/search/prompt/utorrent/unzip/filter",
+        warning_cmdl          = 'Frak!\nIt seems you use command line.\n\nYou must at least provide MODE argument to start:\n\n--mode=episodes/search/file/feed/watch/prompt/unzip/filter/stat\n\n\nexample:   BetaSub.py --mode=episodes   ',
         warning_search        = 'Show title must be 2 or more characters.\n',
         show_not_exist        = 'This show do not exist on Betaseries!\n',
         dir_not_exist         = 'D\'oh! Subtitles directory do not exist.  Verify settings or create the subtitles directory\n',
@@ -1686,6 +4181,7 @@ class Program:
         no_match              = 'No match',
         extract_error         = 'Frak! Search failed...',
         using_updater         = 'You activate the updater!\nsec:',
+        watching              = 'Watching for new videos in',
         extract_info_failed   = 'extract infos failed with file:',
         exit                  = 'exit program.'
 
@@ -1702,11 +4198,15 @@ class Database:
 
     !!! créer des statistics pour les dates.
     """
-    def __init__(self, database='betasub.db', stat=False):
+    def __init__(self, database='betasub.db', stat=False, beta=None):
         """itialisation des variables
 
+        beta: instance de Beta à utiliser pour l'api (créée au premier
+              besoin sinon)
+
         """
         self.db = database
+        self.beta = beta
 
         #creation de la base de donnée
         database = sqlite3.connect(self.db)
@@ -1804,17 +4304,13 @@ class Database:
         """retourne les infos du show.
 
         """
-        beta = Beta()
-        show_list = beta.show_url(show)
-        #si il y a plusieurs choix de séries on prend celui qui correspond le mieux
-        for item in show_list:
-            #test whether every element in showurl is in show
-            if set(item['url']) <= set(show):
-                show = item['url']
-            else:
-                show = show_list[0]['url']
+        if self.beta is None:
+            self.beta = Beta()
+        item = self.beta.resolve_show(show)
+        if item:
+            show = item['url']
 
-        show_info = beta.show_info(show)
+        show_info = self.beta.show_info(show)
         return show_info
 
 
@@ -1879,6 +4375,514 @@ class Database:
 
 
 
+class Outbox:
+    """File d'attente durable des actions membre (downloaded, watched).
+
+    Les actions sont enregistrées dans la base sqlite, puis envoyées par lots
+    en arrière-plan.  Celles qui n'ont pas pu être envoyées (plantage, pas de
+    réseau) restent dans la base et sont rejouées au prochain lancement.
+
+    """
+    def __init__(self, database='betasub.db', batch=20, max_attempts=10):
+        """Initialisation des variables
+
+        batch: nombre d'actions lues à la fois dans la base
+        max_attempts: une action refusée par l'api est abandonnée après ce nombre d'essais
+
+        """
+        self.db = database
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self.flushing = Lock()
+        self.created = False    #table créée au premier accès (connect)
+        #thread d'envoi: un seul à la fois, relancé si start() est rappelé
+        self.state = Lock()
+        self.running = False
+        self.again = False
+        self.thread = None
+
+
+
+    def connect(self):
+        """Ouvre la base; la table n'est créée qu'au premier accès.
+
+        """
+        database = sqlite3.connect(self.db)
+        if not self.created:
+            database.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                action TEXT, login TEXT, show TEXT, season TEXT,
+                                episode TEXT, note TEXT, attempts INTEGER,
+                                time REAL)""")
+            database.commit()
+            self.created = True
+        return database
+
+
+
+    def put(self, action, login, show, season, episode, note=""):
+        """Enregistre une action ('downloaded' ou 'watched') à envoyer.
+
+        """
+        database = self.connect()
+        database.execute("INSERT INTO outbox (action, login, show, season, episode,"
+                         " note, attempts, time) VALUES (?,?,?,?,?,?,0,?)",
+                         (action, login, show, str(season), str(episode),
+                          str(note), time.time()))
+        database.commit()
+        database.close()
+
+
+
+    def pending(self, login, after=0):
+        """Retourne le prochain lot d'actions en attente du membre (id > after).
+
+        """
+        database = self.connect()
+        rows = database.execute("SELECT id, action, show, season, episode, note, "
+                                "attempts FROM outbox WHERE login=? AND id>? "
+                                "ORDER BY id LIMIT ?",
+                                (login, after, self.batch)).fetchall()
+        database.close()
+        return rows
+
+
+
+    def send(self, beta, login, password, row):
+        """Envoie une action, retourne la réponse de l'api (None si refusée).
+
+        """
+        num, action, show, season, episode, note, attempts = row
+        if action == 'watched':
+            result = beta.member_watched(login, password, show, season, episode, note)
+            if result == 1:
+                logging.info("[%s season %s episode %s] is watched on Betaseries !" % (
+                                                        show, season, episode))
+        else:
+            result = beta.member_downloaded(login, password, show, season, episode)
+            #affiche message en console en fonction dur retour
+            if result == "1":
+                logging.info("%s S%sE%s downloaded on Betaseries!" % (
+                                                        show, season, episode))
+            if result == "0":
+                logging.info("%s S%sE%s not downloaded on Betaseries!" % (
+                                                        show, season, episode))
+        return result
+
+
+
+    def flush(self, beta, login, password):
+        """Envoie les actions en attente du membre, par lots.
+
+        S'arrête à la première erreur réseau: les actions restantes seront
+        rejouées plus tard.  Retourne le nombre d'actions envoyées.
+
+        """
+        sent = 0
+        #un seul envoi à la fois
+        if not self.flushing.acquire(False):
+            return sent
+        try:
+            rows = self.pending(login)
+            while rows:
+                database = self.connect()
+                try:
+                    for row in rows:
+                        try:
+                            result = self.send(beta, login, password, row)
+                        except (urllib2.URLError, httplib.HTTPException, socket.error), error:
+                            logging.warning("Betaseries unreachable, %s kept for later (%s)" % (
+                                                                            row[1], error))
+                            return sent
+                        if result is not None or row[6] + 1 >= self.max_attempts:
+                            database.execute("DELETE FROM outbox WHERE id=?", (row[0],))
+                            sent += 1
+                        #refusée, elle sera retentée au prochain lancement
+                        else:
+                            database.execute("UPDATE outbox SET attempts=attempts+1 "
+                                             "WHERE id=?", (row[0],))
+                        database.commit()
+                finally:
+                    database.close()
+                rows = self.pending(login, rows[-1][0])
+            return sent
+        finally:
+            self.flushing.release()
+
+
+
+    def start(self, beta, login, password):
+        """Lance l'envoi en arrière-plan, retourne le thread.
+
+        Si un envoi tourne déjà, il refera un tour avant de s'arrêter: une
+        action ajoutée après sa dernière lecture de la base est envoyée.
+
+        """
+        with self.state:
+            if self.running:
+                self.again = True
+                return self.thread
+            self.running = True
+            self.again = False
+            self.thread = Thread(target=self.run, args=(beta, login, password))
+            self.thread.daemon = True
+            self.thread.start()
+            return self.thread
+
+
+
+    def run(self, beta, login, password):
+        """Boucle du thread d'envoi (voir start).
+
+        """
+        while True:
+            try:
+                self.flush(beta, login, password)
+            except Exception, error:
+                logging.error("outbox: %s" % error)
+            with self.state:
+                if not self.again:
+                    self.running = False
+                    return
+                self.again = False
+
+
+
+    def count(self, login):
+        """Nombre d'actions en attente du membre.
+
+        """
+        database = self.connect()
+        total = database.execute("SELECT COUNT(*) FROM outbox WHERE login=?",
+                                 (login,)).fetchone()[0]
+        database.close()
+        return total
+
+
+
+
+class Library:
+    """Index de la bibliothèque vidéo dans la base sqlite.
+
+    Une ligne par vidéo: taille, date de modification, données extraites du
+    nom et statut ('done', 'pending' ou 'unparsed').  D'un cycle à l'autre,
+    seules les vidéos nouvelles, modifiées ou sans sous-titres sont traitées.
+
+    """
+    def __init__(self, database='betasub.db'):
+        """Initialisation des variables
+
+        """
+        self.db = database
+        self.created = False    #table créée au premier accès (connect)
+
+
+
+    def connect(self):
+        """Ouvre la base; la table n'est créée qu'au premier accès.
+
+        """
+        database = sqlite3.connect(self.db)
+        if not self.created:
+            database.execute("""CREATE TABLE IF NOT EXISTS library (
+                                path TEXT PRIMARY KEY, size INTEGER, mtime REAL,
+                                show TEXT, season TEXT, episode TEXT,
+                                status TEXT, time REAL)""")
+            database.commit()
+            self.created = True
+        return database
+
+
+
+    def pending(self, stats, directory=None):
+        """Liste des vidéos à traiter parmi stats {path: (size, mtime)}.
+
+        Si directory est donné (dossier entièrement parcouru), les vidéos
+        indexées dans directory qui n'existent plus sont retirées de l'index.
+
+        """
+        database = self.connect()
+        try:
+            rows = database.execute("SELECT path, size, mtime, status FROM library").fetchall()
+            known = dict((row[0], row[1:]) for row in rows)
+            gone = []
+            if directory is not None:
+                gone = [(path,) for path in known
+                        if path.startswith(directory) and path not in stats]
+            if gone:
+                database.executemany("DELETE FROM library WHERE path=?", gone)
+                database.commit()
+        finally:
+            database.close()
+
+        videos = []
+        for path in stats:
+            size, mtime = stats[path]
+            row = known.get(path)
+            #inchangée et terminée (ou nom illisible): rien à faire
+            if (row is not None and row[0] == size and row[1] == mtime
+                    and row[2] in ['done', 'unparsed']):
+                continue
+            videos.append(path)
+        return videos
+
+
+
+    def update(self, entries):
+        """Enregistre une liste de (path, size, mtime, show, season, episode, status).
+
+        """
+        now = time.time()
+        database = self.connect()
+        try:
+            database.executemany("INSERT OR REPLACE INTO library VALUES (?,?,?,?,?,?,?,?)",
+                                 [tuple(entry) + (now,) for entry in entries])
+            database.commit()
+        finally:
+            database.close()
+
+
+
+    def count(self, status=None):
+        """Nombre de vidéos indexées (avec ce statut).
+
+        """
+        database = self.connect()
+        try:
+            if status is None:
+                return database.execute("SELECT COUNT(*) FROM library").fetchone()[0]
+            return database.execute("SELECT COUNT(*) FROM library WHERE status=?",
+                                    (status,)).fetchone()[0]
+        finally:
+            database.close()
+
+
+
+
+
+
+
+
+
+
+class Watcher:
+    """Surveille un dossier (et ses sous-dossiers) et met les nouvelles
+    vidéos dans une Queue.
+
+    Sous Linux, inotify (via ctypes) évite tout parcours du dossier quand
+    rien ne bouge; ailleurs, le dossier est scruté toutes les poll secondes.
+    Une vidéo n'est envoyée qu'une fois sa taille stable pendant settle
+    secondes (fichier en cours d'écriture).
+
+    """
+    #constantes inotify (linux/inotify.h)
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+    event_header   = struct.Struct('iIII')
+
+    def __init__(self, directory, extensions, subfolders=False, settle=10,
+                 poll=60, scanner=None):
+        """Initialisation des paramètres.
+
+        scanner: objet avec scan() (Sub), pour lister les dossiers
+
+        """
+        self.directory = directory
+        self.extensions = set(ext.lower().lstrip('.') for ext in extensions)
+        self.subfolders = subfolders == True or subfolders == "True"
+        self.settle = float(settle)
+        self.poll = float(poll)
+        self.scanner = scanner or Sub()
+        self.queue = Queue.Queue()
+        #vidéos en attente de stabilité {path: (échéance, taille)}
+        self.waiting = {}
+        #dossiers surveillés {wd: path}
+        self.watches = {}
+        #dernier parcours, en scrutation {path: (size, mtime)}
+        self.known = None
+        self.fd = None
+        self.libc = None
+
+
+
+    def start(self):
+        """Lance la surveillance dans un thread, retourne la Queue.
+
+        """
+        if not self.init_inotify():
+            logging.info("inotify unavailable, polling every %ss" % self.poll)
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return self.queue
+
+
+
+    def init_inotify(self):
+        """Ouvre inotify et surveille les dossiers. Retourne False si indisponible.
+
+        """
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init()
+        except (OSError, AttributeError):
+            return False
+        if fd < 0:
+            return False
+        self.libc, self.fd = libc, fd
+        self.add_watches(self.directory)
+        return True
+
+
+
+    def add_watches(self, directory, found=False):
+        """Surveille directory (et ses sous-dossiers si subfolders).
+
+        found: dossier apparu pendant la surveillance, ses vidéos sont
+               mises en attente (créées avant que le dossier soit surveillé)
+
+        """
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        folders = [directory]
+        while folders:
+            folder = folders.pop(0)
+            wd = self.libc.inotify_add_watch(self.fd, folder.encode(sys.getfilesystemencoding() or 'utf-8')
+                                             if isinstance(folder, unicode) else folder, mask)
+            if wd < 0:
+                logging.warning("can't watch %s" % folder)
+                continue
+            self.watches[wd] = folder
+            if not self.subfolders and not found:
+                continue
+            for name, path, is_dir, get_stat in self.scanner.list_dir(folder):
+                if name.startswith('.'):
+                    continue
+                if is_dir():
+                    if self.subfolders:
+                        folders.append(path)
+                elif found:
+                    self.changed(path)
+
+
+
+    def run(self):
+        """Boucle de surveillance (thread).
+
+        """
+        while True:
+            try:
+                if self.fd is not None:
+                    self.read_events()
+                else:
+                    self.poll_folder()
+                self.release()
+            except Exception, error:
+                logging.error("watch: %s" % error)
+                time.sleep(self.settle)
+
+
+
+    def read_events(self):
+        """Attend des événements inotify jusqu'à la prochaine échéance.
+
+        """
+        timeout = None
+        if self.waiting:
+            timeout = max(0, min(deadline for deadline, size in self.waiting.values()) - time.time())
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset + self.event_header.size <= len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.watches[wd]
+                continue
+            path = os.path.join(folder, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and self.subfolders:
+                    self.add_watches(path, found=True)
+            else:
+                self.changed(path)
+
+
+
+    def poll_folder(self):
+        """Scrutation: un parcours du dossier toutes les poll secondes.
+
+        Le premier parcours sert de référence, seules les vidéos apparues
+        ou modifiées ensuite sont mises en attente.
+
+        """
+        seen = {}
+        for entry in self.scanner.scan(self.directory, self.extensions, self.subfolders):
+            seen[entry['path']] = (entry['size'], entry['mtime'])
+        known, self.known = self.known, seen
+        if known is not None:
+            for path in seen:
+                if known.get(path) != seen[path]:
+                    self.changed(path)
+        time.sleep(self.poll if not self.waiting else min(self.poll, self.settle))
+
+
+
+    def changed(self, path):
+        """Met une vidéo en attente (ou repousse son échéance).
+
+        """
+        if os.path.splitext(path)[1][1:].lower() not in self.extensions:
+            return
+        if os.path.basename(path).startswith('.'):
+            return
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return
+        self.waiting[path] = (time.time() + self.settle, size)
+
+
+
+    def release(self):
+        """Envoie dans la Queue les vidéos dont la taille n'a pas bougé.
+
+        """
+        now = time.time()
+        for path, (deadline, size) in self.waiting.items():
+            if deadline > now:
+                continue
+            try:
+                current = os.stat(path).st_size
+            except OSError:
+                #fichier disparu (renommé, effacé)
+                del self.waiting[path]
+                continue
+            if current == size:
+                del self.waiting[path]
+                self.queue.put(path)
+            else:
+                self.waiting[path] = (now + self.settle, current)
+
+
+
+
+
+
+
+
+
+
 class Settings:
     """Load Settings.
     
@@ -1963,7 +4967,22 @@ if __name__ == "__main__":
              quality_subtitles       = set_['quality_subtitles'],
              language_subtitles      = set_['language_subtitles'],
              no_download_if_present  = set_['no_download_if_present'],
-             keep_only_one_subtitle  = set_['keep_only_one_subtitle']
+             keep_only_one_subtitle  = set_['keep_only_one_subtitle'],
+             http_pool_size          = set_.get('http_pool_size', 4),
+             use_cache               = set_.get('use_cache', False),
+             workers                 = set_.get('workers', 1),
+             api_rate                = set_.get('api_rate', 0),
+             max_subtitle_kb         = set_.get('max_subtitle_kb', 2048),
+             watch_settle_sec        = set_.get('watch_settle_sec', 10),
+             watch_poll_sec          = set_.get('watch_poll_sec', 60),
+             jobs                    = set_.get('jobs', 0),
+             filters_include         = set_.get('filters_include', ""),
+             filter_match_path       = set_.get('filter_match_path', False),
+             filter_min_kb           = set_.get('filter_min_kb', 0),
+             filter_max_kb           = set_.get('filter_max_kb', 0),
+             filter_dry_run          = set_.get('filter_dry_run', False),
+             extract_best_only       = set_.get('extract_best_only', False),
+             download_top_k          = set_.get('download_top_k', 0)
              )
 
 